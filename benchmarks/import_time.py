@@ -0,0 +1,69 @@
+"""
+Import-time benchmark for the Chicago modules.
+
+Imports each module in a fresh interpreter (best of --repeat runs) and
+reports how long it took and which heavy dependencies came along with it,
+so that e.g. a scrape-only run doesn't start paying for probablepeople or
+the datastore models again.
+
+    python benchmarks/import_time.py [--repeat N]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+MODULES = [
+    'openelex.us.il.places.chicago.scraper',
+    'openelex.us.il.places.chicago.load',
+    'openelex.us.il.places.chicago.transform',
+]
+
+HEAVY = ['probablepeople', 'openelex.models', 'mongoengine', 'pymongo', 'lxml.html', 'scrapelib']
+
+SNIPPET = """
+import json, sys, time
+start = time.time()
+import %s
+seconds = time.time() - start
+print(json.dumps({'seconds': seconds, 'heavy': [m for m in %r if m in sys.modules]}))
+"""
+
+
+def measure(module, repeat=5):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+
+    best = None
+    for _ in range(repeat):
+        proc = subprocess.Popen([sys.executable, '-c', SNIPPET % (module, HEAVY)], env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode:
+            return {'error': err.strip().splitlines()[-1]}
+
+        result = json.loads(out)
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+
+    best['seconds'] = round(best['seconds'], 4)
+    return best
+
+
+def measure_all(repeat=5):
+    return dict((module, measure(module, repeat)) for module in MODULES)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    options = parser.parse_args(argv)
+
+    print json.dumps(measure_all(options.repeat), indent=4, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
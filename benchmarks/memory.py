@@ -0,0 +1,103 @@
+"""
+Peak memory benchmark for the intermediate contest results.
+
+Reads every election json file into memory, in a fresh interpreter per
+representation, and reports how much the process's peak RSS grew over
+what it was after the imports:
+
+* json     the parsed election json dicts, how contests used to be held
+           from parsing to writing (and loading)
+* records  ContestRecords with one StringPool per election, each
+           election's json dropped contest by contest as it's converted
+
+json_over_records is the ratio of the two. Both hold every election at
+once, so they compare the representations rather than what a stage
+actually uses; that is
+
+* loader   LoadResults().run() end to end, one election at a time, into
+           the datastore at `datastore` (a mongoengine host). With an in
+           memory datastore (mongomock) that includes the stored results.
+           Skipped without a datastore.
+
+    python benchmarks/memory.py [election_json dir] [datastore]
+"""
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+REPRESENTATIONS = ['json', 'records']
+
+SNIPPET = """
+import json, os, resource, sys
+from openelex.us.il.places.chicago.records import ContestRecord, StringPool
+
+directory, representation = %r, %r
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+if representation == 'loader':
+    import mongoengine
+    import openelex.models
+    from openelex.us.il.places.chicago.load import LoadResults
+    mongoengine.connect(host=%r)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    os.chdir(os.path.dirname(directory))
+    LoadResults().run()
+    directory = None
+
+held = []
+for filename in sorted(os.listdir(directory)) if directory else []:
+    with open(os.path.join(directory, filename)) as f:
+        election = json.load(f)
+    if representation == 'records':
+        pool = StringPool()
+        contests = election['contests']
+        contests.reverse()
+        records = []
+        while contests:
+            records.append(ContestRecord.from_json(contests.pop(), pool))
+        election = records
+    held.append(election)
+
+# ru_maxrss is in kilobytes on linux
+print(json.dumps({'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before}))
+"""
+
+
+def measure(directory, representation, datastore=None):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+
+    proc = subprocess.Popen([sys.executable, '-c', SNIPPET % (directory, representation, datastore)], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode:
+        return {'error': err.strip().splitlines()[-1]}
+    return json.loads(out)
+
+
+def measure_all(directory='election_json', datastore=None):
+    directory = os.path.abspath(directory)
+    results = dict((representation, measure(directory, representation))
+                   for representation in REPRESENTATIONS)
+    if datastore:
+        results['loader'] = measure(directory, 'loader', datastore)
+    else:
+        results['loader'] = {'skipped': 'needs a datastore'}
+
+    json_kb = results['json'].get('peak_rss_kb')
+    records_kb = results['records'].get('peak_rss_kb')
+    if json_kb and records_kb:
+        results['json_over_records'] = round(float(json_kb) / records_kb, 2)
+    return results
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    print json.dumps(measure_all(*argv[:2]), indent=4, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
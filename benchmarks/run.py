@@ -0,0 +1,254 @@
+"""
+End to end throughput benchmarks against a synthetic, local copy of
+chicagoelections.com.
+
+    python benchmarks/run.py [--elections N] [--contests N] [--wards N]
+                             [--precincts N] [--candidates N]
+                             [--datastore URI] [--save BASELINE]
+                             [--compare BASELINE] [--tolerance 0.25]
+
+Stages:
+
+* scrape     serial Scraper.election_urls / make_elections_json
+* queue      the same scrape through a WorkQueue and a single worker
+* reparse    offline re-parse of the cached ward pages
+* memory     peak RSS of holding the election json vs contest records,
+             and of the loader end to end with --datastore (see memory.py)
+* load       LoadResults into the datastore
+* transform  the three Chicago transforms
+* imports    import time of the Chicago modules (see import_time.py)
+
+load and transform need openelex core and a datastore; pass --datastore
+with a mongoengine host, e.g. mongomock://localhost/bench (in memory,
+requires mongomock) or mongodb://localhost/openelex_bench. Without it
+those stages are skipped.
+
+Results are written as json, including each stage's metrics and how
+much it raised the benchmark process's peak RSS (peak_rss_kb, 0 when an
+earlier stage peaked higher); --save
+stores them as a baseline and --compare exits non-zero if any stage got
+slower than the baseline by more than --tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from synthetic_site import SyntheticSite, SyntheticServer
+from openelex.us.il.places.chicago.metrics import metrics
+
+
+@contextmanager
+def workdir():
+    """
+    The scraper & loader read and write relative to the working directory
+    (.cache, election_json, ...), so every run gets a fresh one.
+    """
+    cwd = os.getcwd()
+    path = tempfile.mkdtemp(prefix='chicago-bench-')
+    os.chdir(path)
+    os.mkdir('election_json')
+    try:
+        yield path
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(path)
+
+
+def make_scraper(base_url):
+    from openelex.us.il.places.chicago.ratelimit import AdaptiveRateLimiter
+    from openelex.us.il.places.chicago.scraper import Scraper
+
+    # the local server can take whatever we throw at it, so
+    # measure the scraper rather than the rate limiter
+    unlimited = AdaptiveRateLimiter(requests_per_minute=10**7,
+                                    max_requests_per_minute=10**7,
+                                    burst=10**7)
+    return Scraper(base_url=base_url, rate_limiter=unlimited)
+
+
+def stage_scrape(base_url, options):
+    scraper = make_scraper(base_url)
+    for elec_name, contests, registered_voters, ballots_cast in scraper.election_urls():
+        scraper.make_elections_json(elec_name, contests, registered_voters, ballots_cast)
+    return {'connections': scraper.connection_stats()}
+
+
+def stage_queue(base_url, options):
+    from openelex.us.il.places.chicago.workqueue import WorkQueue
+
+    # start from an empty election_json, queued elections are only
+    # enqueued if they haven't been scraped yet
+    shutil.rmtree('election_json')
+    os.mkdir('election_json')
+
+    queue = WorkQueue('bench_queue.db')
+    scraper = make_scraper(base_url)
+    scraper.enqueue(queue)
+    scraper.work(queue)
+    return {'units': queue.stats()}
+
+
+def stage_reparse(base_url, options):
+    from openelex.us.il.places.chicago.reparse import reparse
+
+    missing = reparse(processes=options.processes)
+    return {'missing_pages': sum(missing.values())}
+
+
+def stage_load(base_url, options):
+    from openelex.models import RawResult
+    from openelex.us.il.places.chicago.load import LoadResults
+
+    LoadResults().run()
+    return {'raw_results': RawResult.objects.count()}
+
+
+def stage_transform(base_url, options):
+    from openelex.models import Result
+    from openelex.us.il.places.chicago.transform import (CreateContestsTransform,
+        CreateCandidatesTransform, CreateResultsTransform)
+
+    timings = {}
+    for transform in (CreateContestsTransform, CreateCandidatesTransform, CreateResultsTransform):
+        start = time.time()
+        transform()()
+        timings[transform.name] = round(time.time() - start, 4)
+    return {'transforms': timings, 'results': Result.objects.count()}
+
+
+def stage_memory(base_url, options):
+    import memory
+    return {'representations': memory.measure_all('election_json', options.datastore)}
+
+
+def stage_imports(base_url, options):
+    import import_time
+    return {'modules': import_time.measure_all()}
+
+
+STAGES = [
+    ('scrape', stage_scrape, 'ward_pages'),
+    ('queue', stage_queue, 'ward_pages'),
+    ('reparse', stage_reparse, 'ward_pages'),
+    ('memory', stage_memory, None),
+    ('load', stage_load, 'precincts'),
+    ('transform', stage_transform, 'precincts'),
+    ('imports', stage_imports, None),
+]
+DATASTORE_STAGES = set(['load', 'transform'])
+
+
+def connect_datastore(uri):
+    import mongoengine
+    mongoengine.connect(host=uri)
+
+
+def run(options):
+    site = SyntheticSite(elections=options.elections, contests=options.contests,
+                         wards=options.wards, precincts=options.precincts,
+                         candidates=options.candidates)
+    server = SyntheticServer(site).start()
+
+    if options.datastore:
+        connect_datastore(options.datastore)
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'params': site.totals,
+        'stages': {},
+    }
+    report['params']['candidates'] = options.candidates
+
+    try:
+        with workdir():
+            for name, stage, unit in STAGES:
+                if options.stages and name not in options.stages:
+                    continue
+                if name in DATASTORE_STAGES and not options.datastore:
+                    report['stages'][name] = {'skipped': 'no --datastore'}
+                    continue
+
+                metrics.reset()
+                peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                start = time.time()
+                extra = stage(server.base_url, options)
+                seconds = time.time() - start
+                peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak_rss
+
+                report['stages'][name] = dict(extra, **{
+                    'seconds': round(seconds, 4),
+                    'peak_rss_kb': peak_rss,
+                    'unit': unit,
+                    'per_second': round(site.totals[unit] / seconds, 2) if unit and seconds else None,
+                    'metrics': metrics.summary(),
+                })
+    finally:
+        server.shutdown()
+
+    return report
+
+
+def compare(report, baseline, tolerance):
+    """
+    Returns a list of the stages that are slower than in the baseline.
+    """
+    regressions = []
+    if baseline['params'] != report['params']:
+        print >> sys.stderr, "warning: baseline was recorded with different parameters"
+
+    for name, stage in sorted(report['stages'].items()):
+        before = baseline['stages'].get(name, {}).get('seconds')
+        after = stage.get('seconds')
+        if before and after and after > before * (1 + tolerance):
+            regressions.append('%s: %.3fs -> %.3fs (+%d%%)'
+                               % (name, before, after, 100 * (after / before - 1)))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--elections', type=int, default=2)
+    parser.add_argument('--contests', type=int, default=8)
+    parser.add_argument('--wards', type=int, default=50)
+    parser.add_argument('--precincts', type=int, default=40)
+    parser.add_argument('--candidates', type=int, default=3)
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes for the reparse stage')
+    parser.add_argument('--stages', nargs='*', choices=[name for name, _, _ in STAGES])
+    parser.add_argument('--datastore', help='mongoengine host uri for load & transform')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--save', metavar='BASELINE', help='store the results as a baseline')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare against a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    options = parser.parse_args(argv)
+
+    report = run(options)
+    output = json.dumps(report, indent=4, sort_keys=True)
+    print output
+
+    for path in filter(None, [options.output, options.save]):
+        with open(path, 'w') as f:
+            f.write(output + '\n')
+
+    if options.compare:
+        with open(options.compare) as f:
+            regressions = compare(report, json.load(f), options.tolerance)
+        for regression in regressions:
+            print >> sys.stderr, "REGRESSION", regression
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,189 @@
+"""
+Local stand-in for chicagoelections.com.
+
+Generates a deterministic, synthetic election archive with the markup the
+Scraper expects (election & contest option lists, ward link tables and
+precinct tables with a Total row) and serves it over HTTP.
+"""
+import random
+import threading
+import urllib
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+GIVEN_NAMES = ['MARY', 'JAMES', 'PATRICIA', 'JOHN', 'LINDA', 'ROBERT', 'BARBARA',
+               'MICHAEL', 'ELIZABETH', 'WILLIAM', 'SUSAN', 'DAVID', 'KAREN', 'RICHARD']
+FAMILY_NAMES = ['SMITH', 'JOHNSON', 'WILLIAMS', 'BROWN', 'JONES', 'GARCIA', 'MILLER',
+                'DAVIS', 'RODRIGUEZ', 'MARTINEZ', 'HERNANDEZ', 'LOPEZ', 'WILSON', 'ANDERSON']
+
+# contest names the loader & transforms recognize, %d is the district
+OFFICES = ['MAYOR', 'CLERK', 'TREASURER', 'ALDERMAN %d WARD',
+           'WARD COMMITTEEMAN %d WARD', 'STATE REPRESENTATIVE %d DISTRICT',
+           'REPRESENTATIVE IN CONGRESS %d DISTRICT', 'STATE SENATOR %d DISTRICT']
+
+# enumerated by the scraper, but not turned into contests
+SUMMARY_CONTESTS = ['REGISTERED VOTERS - TOTAL', 'BALLOTS CAST - TOTAL']
+
+
+class SyntheticSite(object):
+
+    def __init__(self, elections=2, contests=4, wards=5, precincts=10, candidates=3, seed=0):
+        self.num_contests = contests
+        self.num_wards = wards
+        self.num_precincts = precincts
+
+        rand = random.Random(seed)
+
+        self.elections = []
+        for e in range(elections):
+            # the scraper drops the first 5 characters of the option value
+            name = '%-5d%s - 02/%02d/%d' % (e, 'Municipal General %d' % e,
+                                            1 + e % 28, 2015 - e // 28)
+            contests = []
+            for c in range(self.num_contests):
+                office, district = OFFICES[c % len(OFFICES)], 1 + c // len(OFFICES)
+                if '%d' in office:
+                    office = office % district
+                elif district > 1:
+                    office = '%s %d' % (office, district)
+                names = set()
+                while len(names) < candidates:
+                    names.add('%s %s' % (rand.choice(GIVEN_NAMES), rand.choice(FAMILY_NAMES)))
+                contests.append((office, sorted(names)))
+            self.elections.append((name, contests))
+
+        self._seed = seed
+
+    def votes(self, e, c, w, p):
+        rand = random.Random('%s-%s-%s-%s-%s' % (self._seed, e, c, w, p))
+        return [rand.randint(0, 400) for _ in self.elections[e][1][c][1]]
+
+    @property
+    def totals(self):
+        contests = sum(len(contests) for _, contests in self.elections)
+        return {
+            'elections': len(self.elections),
+            'contests': contests,
+            'ward_pages': contests * self.num_wards,
+            'precincts': contests * self.num_wards * self.num_precincts,
+        }
+
+    def start_page(self):
+        options = ''.join('<option value="%s">%s</option>' % (name, name[5:])
+                          for name, _ in self.elections)
+        return ('<html><body><table class="maincontent"><tr><td>'
+                '<form method="post"><select name="D3">%s</select></form>'
+                '</td></tr></table></body></html>' % options)
+
+    def contest_select_page(self, e):
+        names = SUMMARY_CONTESTS + [office for office, _ in self.elections[e][1]]
+        options = ''.join('<option value="%s">%s</option>' % (name, name) for name in names)
+        return ('<html><body><table class="maincontent"><tr><td>'
+                '<form method="post"><select name="D3">%s</select></form>'
+                '</td></tr></table></body></html>' % options)
+
+    def ward_links_page(self, e, contest_name):
+        offices = [office for office, _ in self.elections[e][1]]
+        # summary contests link to a race number past the real contests
+        c = offices.index(contest_name) if contest_name in offices else len(offices)
+        rows = ''.join('<tr><td><a href="wdlevel3.asp?elec_code=%d&race_number=%d&ward=%d">%d</a></td></tr>'
+                       % (e, c, w, w) for w in range(1, self.num_wards + 1))
+        return '<html><body><table>%s</table></body></html>' % rows
+
+    def ward_page(self, e, c, w):
+        if c >= len(self.elections[e][1]):
+            return '<html><body>Ward, election selected or contest was bad</body></html>'
+
+        office, candidates = self.elections[e][1][c]
+        header = '<td>Precinct</td><td>Votes</td>' + ''.join(
+            '<td>%s</td><td>%%</td>' % name for name in candidates)
+
+        rows = []
+        totals = [0] * len(candidates)
+        for p in range(1, self.num_precincts + 1):
+            votes = self.votes(e, c, w, p)
+            cast = sum(votes) or 1
+            totals = [t + v for t, v in zip(totals, votes)]
+            rows.append('<tr><td>%d</td><td>%d</td>%s</tr>' % (p, sum(votes), ''.join(
+                '<td>%d</td><td>%.2f%%</td>' % (v, 100.0 * v / cast) for v in votes)))
+        rows.append('<tr><td>Total</td><td>%d</td>%s</tr>' % (sum(totals), ''.join(
+            '<td>%d</td><td></td>' % t for t in totals)))
+
+        return ('<html><body><table><tr><td>%s - Ward %d</td></tr><tr>%s</tr>%s</table>'
+                '</body></html>' % (office, w, header, ''.join(rows)))
+
+
+class SyntheticSiteHandler(BaseHTTPRequestHandler):
+    # keep-alive, like the real site
+    protocol_version = 'HTTP/1.1'
+    # send each response in one write, otherwise delayed acks
+    # add ~40ms to every request and swamp the measurements
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send_page(self, html, status=200, headers=()):
+        body = html.encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        site = self.server.site
+        path, _, query = self.path.partition('?')
+        params = dict(urlparse.parse_qsl(query))
+
+        if path == '/en/election3.asp' and 'election' in params:
+            self.send_page(site.contest_select_page(int(params['election'])))
+        elif path == '/en/election3.asp':
+            self.send_page(site.start_page())
+        elif path == '/en/wdlevel3.asp':
+            self.send_page(site.ward_page(int(params['elec_code']),
+                                          int(params['race_number']),
+                                          int(params['ward'])))
+        else:
+            self.send_page('not found', status=404)
+
+    def do_POST(self):
+        site = self.server.site
+        path, _, query = self.path.partition('?')
+        params = dict(urlparse.parse_qsl(query))
+        length = int(self.headers.getheader('Content-Length') or 0)
+        form = dict(urlparse.parse_qsl(self.rfile.read(length)))
+
+        if path != '/en/election3.asp':
+            self.send_page('not found', status=404)
+        elif 'flag1' in form:
+            # selecting an election redirects to its contest list, the
+            # scraper then posts contest selections to that url
+            e = [name for name, _ in site.elections].index(form['D3'])
+            self.send_page('', status=303, headers=[
+                ('Location', '/en/election3.asp?' + urllib.urlencode({'election': e}))])
+        else:
+            self.send_page(site.ward_links_page(int(params['election']), form['D3']))
+
+
+class SyntheticServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, site, host='127.0.0.1', port=0):
+        HTTPServer.__init__(self, (host, port), SyntheticSiteHandler)
+        self.site = site
+
+    @property
+    def base_url(self):
+        return 'http://%s:%d/' % self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
@@ -0,0 +1,139 @@
+"""
+Indexes for the query shapes the Chicago transforms use.
+
+Each index matches one datastore lookup the transforms make in their per
+raw result loops, field for field, so that none of them turns into a
+collection scan as the data grows. Create them (idempotently) with
+
+    python -m openelex.us.il.places.chicago.indexes
+
+and add --explain to check which index each transform query actually uses.
+
+None of them are unique: the Office collection is shared with the other
+loaders, so the transforms cope with duplicate offices instead (see
+BaseTransform.prepare_offices).
+"""
+import sys
+
+from pymongo import ASCENDING
+
+from openelex.models import Candidate, Contest, Office, RawResult, Result
+
+from .transform import candidate_fields, contest_fields, office_fields
+
+
+def _lookup_fields(fields, reference):
+    # get_contest & get_candidate drop 'source' and add the referenced document
+    return [reference] + [f for f in fields if f != 'source']
+
+
+# (index name, model, fields, the transform query it serves)
+INDEXES = [
+    ('chicago_raw_results', RawResult, ['state', 'place'],
+        'BaseTransform.get_raw_results'),
+    ('chicago_raw_results_election', RawResult, ['election_id'],
+        'CreateResultsTransform.get_election_ids'),
+    ('chicago_contest_lookup', Contest, _lookup_fields(contest_fields, 'office'),
+        'BaseTransform.get_contest'),
+    ('chicago_candidate_lookup', Candidate, _lookup_fields(candidate_fields, 'contest'),
+        'CreateResultsTransform.get_candidate'),
+    ('chicago_office_lookup', Office, office_fields,
+        'BaseTransform.prepare_offices'),
+    ('chicago_results_election', Result, ['election_id'],
+        'CreateResultsTransform.get_results'),
+]
+
+
+def _db_fields(model, fields):
+    return [model._fields[f].db_field if f in model._fields else f for f in fields]
+
+
+def ensure_indexes():
+    """
+    Creates any missing index. Returns the names of the indexes.
+    """
+    names = []
+    for name, model, fields, _ in INDEXES:
+        collection = model._get_collection()
+        keys = [(f, ASCENDING) for f in _db_fields(model, fields)]
+
+        if collection.index_information().get(name, {}).get('unique'):
+            # a unique chicago_office_lookup, which made other loaders'
+            # office saves fail on duplicates
+            collection.drop_index(name)
+
+        collection.create_index(keys, name=name, background=True)
+        names.append(name)
+    return names
+
+
+def _index_used(plan):
+    """
+    Name of the index the winning plan of an explain() uses, or None for a
+    collection scan. Handles both the query planner (MongoDB >= 3.0) and
+    the legacy explain output.
+    """
+    if 'queryPlanner' in plan:
+        stages = [plan['queryPlanner']['winningPlan']]
+        while stages:
+            stage = stages.pop()
+            if 'indexName' in stage:
+                return stage['indexName']
+            for key in ('inputStage', 'inputStages'):
+                child = stage.get(key)
+                if isinstance(child, list):
+                    stages.extend(child)
+                elif child:
+                    stages.append(child)
+        return None
+
+    cursor = plan.get('cursor', '')
+    if cursor.startswith('BtreeCursor '):
+        return cursor.split(' ')[1]
+    return None
+
+
+def explain():
+    """
+    Runs each indexed transform query against a document already in the
+    datastore and reports the index it uses: a list of
+    (transform query, index name, index used or None) tuples. Queries on
+    empty collections are reported with 'no data'.
+    """
+    usage = []
+    for name, model, fields, query in INDEXES:
+        collection = model._get_collection()
+        db_fields = _db_fields(model, fields)
+
+        sample = collection.find_one({}, dict((f, 1) for f in db_fields))
+        if sample is None:
+            usage.append((query, name, 'no data'))
+            continue
+
+        spec = dict((f, sample.get(f)) for f in db_fields)
+        usage.append((query, name, _index_used(collection.find(spec).explain())))
+    return usage
+
+
+def main(argv=None):
+    """
+    python -m openelex.us.il.places.chicago.indexes [--explain]
+    """
+    argv = sys.argv[1:] if argv is None else argv
+
+    for name in ensure_indexes():
+        print "ensured index %s" % name
+
+    if '--explain' in argv:
+        for query, name, used in explain():
+            if used == 'no data':
+                status = 'skipped, collection is empty'
+            else:
+                status = 'ok' if used == name else 'NOT USING %s' % name
+            print "%-40s %-32s %s" % (query, used or 'COLLSCAN', status)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
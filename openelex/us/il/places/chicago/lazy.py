@@ -0,0 +1,26 @@
+import importlib
+
+
+class LazyModule(object):
+    """
+    Stands in for a module until one of its attributes is first used.
+
+    Lets modules that are imported just to register themselves (e.g. the
+    transforms) avoid paying for heavy dependencies, like probablepeople's
+    CRF model or the datastore models, until the code that needs them runs.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return '<lazy module %r%s>' % (self._name, '' if self._module is None else ' (loaded)')
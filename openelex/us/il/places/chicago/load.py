@@ -2,7 +2,16 @@ import os
 import json
 import datetime
 
-from openelex.models import RawResult
+from .lazy import LazyModule
+from .metrics import log, metrics
+from .records import ContestRecord, StringPool
+from .rollup import Rollup, RollupStore
+
+# loaded on first use, so importing the loader doesn't pull in the datastore
+models = LazyModule('openelex.models')
+
+# raw results are inserted in batches of this many, rather than all at once
+INSERT_BATCH_SIZE = 1000
 
 
 class LoadResults(object):
@@ -18,12 +27,15 @@ class LoadResults(object):
 
 		for json_file in json_files:
 			with open('election_json/'+json_file) as f:
-				content = f.read()
-				election_json = json.loads(content)
+				election_json = json.load(f)
 				elec_metadata = self.make_elec_metadata(election_json['election_name'], json_file)
 			
 			loader = ChicagoLoader()
-			loader.load(elec_metadata)
+			with metrics.context(election=election_json['election_name']), metrics.timer('load', 'election'):
+				# handed over, the loader drops each contest as it's loaded
+				loader.load(elec_metadata, election_json, consume=True)
+			# let the parsed json go before the next file is read
+			del election_json
 
 	# metadata that we gather from the filename & the election name
 	def make_elec_metadata(self, election_name, filename):
@@ -70,13 +82,23 @@ class LoadResults(object):
 			'party': name_party,
 		}
 
-		print "loading election:", election_name
+		log.info("loading election: %s", election_name)
 
 		return elec_metadata
 
 class ChicagoLoader():
 
-	def load(self, elec_metadata):
+	def __init__(self, rollups=None):
+		self.rollups = rollups or RollupStore()
+
+	def load(self, elec_metadata, election_json=None, consume=False):
+		"""
+		Loads an election's json, read from its file unless it's passed in.
+		A caller's election_json is left as it was, unless the caller hands
+		it over with consume=True: its contests are then dropped as they're
+		loaded, as they are when the file is read here, so the parsed json
+		shrinks while the contests' records are built.
+		"""
 
 		try:
 			elec_date = datetime.datetime.strptime(elec_metadata['date'], '%m/%d/%y')
@@ -96,26 +118,50 @@ class ChicagoLoader():
 			'result_type': 'certified',
 		}
 
-		results = []
-
-		# loop through json, do stuff to add to kwargs
-		with open('election_json/'+elec_metadata['filename']) as f:
-			content = f.read()
-			election_json = json.loads(content)
-
-			for contest in election_json['contests']:
+		if election_json is None:
+			with open('election_json/'+elec_metadata['filename']) as f:
+				election_json = json.load(f)
+			consume = True
+
+		# candidate names & jurisdictions repeat across contests, so share one copy of each
+		pool = StringPool()
+		rollup = Rollup()
+		batch = []
+
+		# loop through json, do stuff to add to kwargs. contests are popped off
+		# the end, so they're reversed first (a copy, unless ours to consume)
+		if consume:
+			contests = election_json['contests']
+			contests.reverse()
+		else:
+			contests = election_json['contests'][::-1]
+		while contests:
+			contest_json = contests.pop()
+
+			contest_args = self.get_contest_args(chicago_args, contest_json['position'])
+
+			if contest_args:
+				log.debug("   loading contest: %s", contest_json['position'])
+				contest = ContestRecord.from_json(contest_json, pool)
+				rollup.add_wards(contest_args['office'], contest.wards)
+				for raw_result in self.make_results(contest_args, contest.wards):
+					batch.append(raw_result)
+					if len(batch) >= INSERT_BATCH_SIZE:
+						self.insert(batch)
+						batch = []
+			else:
+				log.info("   contest not loaded: %s", contest_json['position'])
+				metrics.count('load', 'contests_skipped')
 
-				contest_args = self.get_contest_args(chicago_args, contest['position'])
+		if batch:
+			self.insert(batch)
 
-				if contest_args:
-					# print "   loading contest:", contest['position']
-					contest_results = self.make_results(contest_args, contest['results'])
-					results.extend(contest_results)
-				else:
-					print "   contest not loaded:", contest['position']
+		self.rollups.replace(chicago_args['election_id'], 'raw', rollup)
 
-		if results:
-			RawResult.objects.insert(results)
+	def insert(self, raw_results):
+		metrics.count('load', 'rows', len(raw_results))
+		with metrics.timer('load', 'insert'):
+			models.RawResult.objects.insert(raw_results)
 
 	def get_contest_args(self, chicago_args, position):
 		
@@ -184,41 +230,33 @@ class ChicagoLoader():
 
 
 
-	def make_results(self, contest_args, results):
-
-		raw_result_list = []
-		for result in results:
+	def make_results(self, contest_args, wards):
 
-			result_jurisdiction = "ward %s" % result['ward']
+		for ward in wards:
 			# TO DO: add "ocd_id"
 
 			# adding ward results
-			for candidate in result['candidate_totals']:
+			for candidate, votes in ward.candidate_totals():
 				result_args = {
 					'full_name': candidate,
-					'votes': result['candidate_totals'][candidate],
+					'votes': votes,
 					'reporting_level': 'municipal_district',
-					'jurisdiction': result_jurisdiction,
+					'jurisdiction': ward.jurisdiction,
 				}
 				result_args.update(contest_args)
-				raw_result_list.append(RawResult(**result_args))
+				yield models.RawResult(**result_args)
 
 			# adding precinct results
-			for precinct_result in result['results_by_precinct']:
-
-				result_jurisdiction = "ward %s precinct %s" %(result['ward'], precinct_result['precinct'])
+			for precinct in ward.precincts:
 				# TO DO: add "ocd_id"
 
-				for candidate in precinct_result['candidate_totals']:
+				for candidate, votes in ward.precinct_totals(precinct):
 					result_args = {
 						'full_name': candidate,
-						'votes': precinct_result['candidate_totals'][candidate],
+						'votes': votes,
 						'reporting_level': 'precinct',
-						'jurisdiction': result_jurisdiction,
+						'jurisdiction': precinct.jurisdiction,
 					}
 
 				result_args.update(contest_args)
-				raw_result_list.append(RawResult(**result_args))
-
-		return raw_result_list
-
+				yield models.RawResult(**result_args)
@@ -0,0 +1,155 @@
+"""
+Timers and counters for the scrape, load and transform stages.
+
+Every measurement is recorded under a stage ('scrape', 'load',
+'transform'), a metric name and labels. Labels come from the call and from
+any enclosing `metrics.context(...)` blocks, so a fetch made while scraping
+a contest is attributed to that election and contest without the fetch
+having to know about either.
+
+Measurements are aggregated as they come in (count, total, min, max per
+stage/metric/labels), so memory use doesn't grow with the number of rows
+processed. Export them with `metrics.export_jsonl(path)` or print
+`metrics.report()`.
+
+Messages go to the 'openelex.us.il.places.chicago' logger. Warnings and
+errors (skipped contests, broken pages, ...) are printed to stderr,
+progress messages only with CHICAGO_VERBOSE=1. Set CHICAGO_METRICS=<path>
+to write the metrics as json lines when the process exits.
+"""
+import atexit
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger('openelex.us.il.places.chicago')
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._data = {}
+
+    def _labels(self, labels):
+        merged = {}
+        for context in getattr(self._local, 'contexts', []):
+            merged.update(context)
+        merged.update(labels)
+        return tuple(sorted(merged.items()))
+
+    def record(self, stage, name, value, kind='counter', **labels):
+        key = (stage, name, kind, self._labels(labels))
+        with self._lock:
+            agg = self._data.get(key)
+            if agg is None:
+                self._data[key] = [1, value, value, value]
+            else:
+                agg[0] += 1
+                agg[1] += value
+                agg[2] = min(agg[2], value)
+                agg[3] = max(agg[3], value)
+
+    def count(self, stage, name, value=1, **labels):
+        self.record(stage, name, value, 'counter', **labels)
+
+    @contextmanager
+    def timer(self, stage, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, name, time.time() - start, 'timer', **labels)
+
+    @contextmanager
+    def context(self, **labels):
+        """
+        Attach labels to everything recorded in this thread inside the block.
+        """
+        contexts = getattr(self._local, 'contexts', None)
+        if contexts is None:
+            contexts = self._local.contexts = []
+        contexts.append(labels)
+        try:
+            yield
+        finally:
+            contexts.pop()
+
+    def reset(self):
+        with self._lock:
+            self._data = {}
+
+    def rows(self):
+        """
+        One dict per stage/metric/labels combination.
+        """
+        with self._lock:
+            items = sorted(self._data.items())
+
+        rows = []
+        for (stage, name, kind, labels), (count, total, low, high) in items:
+            rows.append({
+                'stage': stage,
+                'metric': name,
+                'type': kind,
+                'labels': dict(labels),
+                'count': count,
+                'total': total,
+                'min': low,
+                'max': high,
+            })
+        return rows
+
+    def summary(self):
+        """
+        Aggregates across labels: {stage: {metric: {...}}}.
+        """
+        summary = {}
+        for row in self.rows():
+            metric = summary.setdefault(row['stage'], {}).setdefault(row['metric'], {
+                'type': row['type'], 'count': 0, 'total': 0, 'min': row['min'], 'max': row['max'],
+            })
+            metric['count'] += row['count']
+            metric['total'] += row['total']
+            metric['min'] = min(metric['min'], row['min'])
+            metric['max'] = max(metric['max'], row['max'])
+
+        for metrics in summary.values():
+            for metric in metrics.values():
+                if metric['type'] == 'timer':
+                    metric['mean'] = metric['total'] / metric['count']
+        return summary
+
+    def export_jsonl(self, path):
+        with open(path, 'w') as f:
+            for row in self.rows():
+                f.write(json.dumps(row, sort_keys=True) + '\n')
+
+    def report(self):
+        lines = []
+        for stage, stage_metrics in sorted(self.summary().items()):
+            lines.append(stage)
+            for name, metric in sorted(stage_metrics.items()):
+                if metric['type'] == 'timer':
+                    lines.append('  %-24s %8d calls %10.3fs total %8.4fs mean %8.4fs max'
+                                 % (name, metric['count'], metric['total'], metric['mean'], metric['max']))
+                else:
+                    lines.append('  %-24s %8d' % (name, metric['total']))
+        return '\n'.join(lines)
+
+
+metrics = Metrics()
+
+
+_handler = logging.StreamHandler(sys.stderr)
+_handler.setFormatter(logging.Formatter('%(message)s'))
+log.addHandler(_handler)
+log.setLevel(logging.INFO if os.environ.get('CHICAGO_VERBOSE') else logging.WARNING)
+
+if os.environ.get('CHICAGO_METRICS'):
+    atexit.register(metrics.export_jsonl, os.environ['CHICAGO_METRICS'])
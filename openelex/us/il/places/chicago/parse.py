@@ -0,0 +1,117 @@
+import re
+
+import lxml.html
+
+from .metrics import log, metrics
+from .records import MISSING, WardRecord
+
+# a ward page's header row is the contest name followed by e.g. ' - Ward 12'
+WARD_SUFFIX = re.compile(r'\s*-\s*ward\s+\d+\s*$', re.I)
+
+
+def parse_election_names(html):
+    """
+    The election option values of the start page.
+    """
+    tree = lxml.html.fromstring(html)
+    return tree.xpath("//table[@class='maincontent']//select/option/@value")
+
+
+def parse_contest_name(html):
+    """
+    The contest a ward results page belongs to, from its header row, or
+    None if the page is broken.
+    """
+    if 'ward, election selected or contest was bad' in html.lower():
+        return None
+
+    tree = lxml.html.fromstring(html)
+    header = tree.xpath("string(//table[1]//tr[1])").strip()
+    return WARD_SUFFIX.sub('', header) or None
+
+
+def parse_ward_page(html, ward, contest_name, url, pool=None):
+    """
+    Parses the precinct results table of a single ward results page.
+
+    Returns a WardRecord, its strings interned in `pool` (see records.py),
+    or None if the page is broken or has no precinct level data. Kept
+    separate from the Scraper so that pages can be parsed without fetching
+    them.
+    """
+    with metrics.timer('scrape', 'parse'):
+        ward_result = _parse_ward_page(html, ward, contest_name, url, pool)
+
+    if ward_result:
+        metrics.count('scrape', 'precincts', len(ward_result.precincts))
+    return ward_result
+
+
+def _parse_ward_page(html, ward, contest_name, url, pool):
+
+    if 'ward, election selected or contest was bad' in html.lower():
+        log.warning("ERROR: BROKEN RESULTS PAGE - url: %s", url)
+        metrics.count('scrape', 'broken_pages')
+        return None
+
+    tree = lxml.html.fromstring(html)
+
+    header_td_list = tree.xpath("//table[1]//tr[2]//td")
+    tbl_header = [td.xpath("string(.)") for td in header_td_list]
+    num_cols = len(tbl_header)
+
+    # finding the position of the last row of results (the row w/ totals)
+    # b/c sometimes there are extra non-result rows in the table
+    rows = tree.xpath("//table[1]//tr")
+    first_col_str = [tr.xpath("td")[0].xpath("string(.)") if tr.xpath("td") else None for tr in rows]
+    if 'Total' in first_col_str:
+        idx_total_row = list(reversed(first_col_str)).index('Total')
+        precinct_td_list = tree.xpath("//table[1]//tr[position() > 2 and not(position() > last()-%s)]//td" % (idx_total_row+1))
+        precinct_data = [precinct_td_list[i:i+num_cols] for i in range(0, len(precinct_td_list), num_cols)]
+    else:
+        precinct_td_list = tree.xpath("//table[1]//tr[position() > 2]//td")
+        precinct_data = [precinct_td_list[i:i+num_cols] for i in range(0, len(precinct_td_list), num_cols)]
+
+    if not precinct_data:
+        log.warning("ERROR: MISSING PRECINCT LEVEL DATA - contest: %s, ward: %s", contest_name, ward)
+        metrics.count('scrape', 'missing_precinct_data')
+        return None
+
+    totals = []
+    # loop through columns
+    for i in range(0, len(precinct_data[0])):
+        col_total = 0
+        # loop through rows to get the sum of all values in a column
+        for row in precinct_data:
+            try:
+                parsed_num = int(row[i].xpath("string(.)"))
+                col_total += parsed_num
+            except:
+                # sometimes these will be percentages but these will be ignored later anyways
+                col_total = None
+        totals.append(col_total)
+
+    # TO-DO: distinguish between voting on candidates vs voting on Y/N vote?
+    if len(tbl_header) > 2: # more than one candidate running
+        candidates = tbl_header[2::2]
+        votes_totals = totals[2::2]
+    else: # only one candidate
+        candidates = [tbl_header[1]]
+        votes_totals = [totals[1]]
+
+    ward_result = WardRecord(ward, candidates, [int(votes_total) for votes_total in votes_totals], pool)
+
+    for row in precinct_data:
+        row_string = [td.xpath("string(.)") for td in row]
+        precinct = row_string[0]
+
+        if num_cols > 2:
+            votes_precinct = row_string[2::2]
+        else: # only one candidate
+            votes_precinct = [row_string[1]]
+
+        votes = [int(vote) for vote in votes_precinct[:len(candidates)]]
+        votes.extend([MISSING] * (len(candidates) - len(votes)))
+        ward_result.add_precinct(precinct, votes, pool)
+
+    return ward_result
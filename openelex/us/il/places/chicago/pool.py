@@ -0,0 +1,64 @@
+from requests.adapters import HTTPAdapter, DEFAULT_POOLSIZE
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that keeps a bounded pool of keep-alive connections per host
+    and counts how often those connections are reused.
+
+    urllib3 tracks connections opened and requests sent per connection pool;
+    the counts of pools dropped from the pool manager are carried over so
+    that `connection_stats` covers the adapter's whole lifetime.
+    """
+
+    def __init__(   self,
+                    pool_connections=DEFAULT_POOLSIZE,
+                    pool_maxsize=DEFAULT_POOLSIZE,
+                    keep_alive=True,
+                    **kwargs ):
+
+        self.keep_alive = keep_alive
+        self._retired_connections = 0
+        self._retired_requests = 0
+
+        super(PooledAdapter, self).__init__(pool_connections=pool_connections,
+                                            pool_maxsize=pool_maxsize,
+                                            **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(PooledAdapter, self).init_poolmanager(*args, **kwargs)
+
+        pools = self.poolmanager.pools
+        dispose = pools.dispose_func
+
+        def retire(pool):
+            self._retired_connections += pool.num_connections
+            self._retired_requests += pool.num_requests
+            if dispose:
+                dispose(pool)
+
+        pools.dispose_func = retire
+
+    def add_headers(self, request, **kwargs):
+        if not self.keep_alive:
+            request.headers['Connection'] = 'close'
+
+    def connection_stats(self):
+        """
+        Returns a dict with the number of connections opened, requests sent
+        and requests that went over an already open connection.
+        """
+        connections = self._retired_connections
+        requests_sent = self._retired_requests
+
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            connections += pool.num_connections
+            requests_sent += pool.num_requests
+
+        return {
+            'connections': connections,
+            'requests': requests_sent,
+            'reused': max(0, requests_sent - connections),
+        }
@@ -0,0 +1,242 @@
+import errno
+import fcntl
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# what a limiter shares with the other processes using its state_file
+SHARED_STATE = ['rate', 'burst', 'concurrency', '_tokens', '_last_refill', '_in_flight',
+                '_failures', '_successes', '_backoff_until']
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class AdaptiveRateLimiter(object):
+    """
+    Token bucket shared by every fetch path of the scraper.
+
+    Tokens refill at `rate` requests per second, up to `burst` tokens, and
+    at most `concurrency` requests may be in flight at once. Both limits
+    adapt to what the server tells us: fast, successful responses slowly
+    widen them (additive increase) while errors and slow responses cut them
+    in half (multiplicative decrease) and open a backoff window that grows
+    exponentially with consecutive failures, with full jitter.
+
+    The limiter is thread-safe. Threaded callers use `acquire`/`release`
+    (or the `request` context manager); callers running on an event loop
+    can use `reserve`, which never sleeps and returns the number of seconds
+    to wait before trying again. `concurrency` only comes into play when
+    several threads (or processes, see below) share a limiter, a single
+    Scraper fetches one page at a time.
+
+    By default a limiter is private to its process, so e.g. several queue
+    workers would each get the full rate. Give every process the same
+    `state_file` to have them share one bucket, concurrency limit and
+    backoff instead: the state then lives in that file, under an flock, and
+    slots held by processes that died are given back. The processes must
+    all be on one machine.
+    """
+
+    def __init__(   self,
+                    requests_per_minute=100,
+                    min_requests_per_minute=6,
+                    max_requests_per_minute=600,
+                    burst=None,
+                    concurrency=1,
+                    max_concurrency=8,
+                    target_latency=2.0,
+                    backoff_base=2.0,
+                    backoff_max=120.0,
+                    state_file=None,
+                    clock=time.time,
+                    sleep=time.sleep ):
+
+        self.min_rate = min_requests_per_minute / 60.0
+        self.max_rate = max_requests_per_minute / 60.0
+        self.rate = min(max(requests_per_minute / 60.0, self.min_rate), self.max_rate)
+        self.burst = burst or max(1, concurrency)
+        self.concurrency = concurrency
+        self.max_concurrency = max(max_concurrency, concurrency)
+        self.target_latency = target_latency
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.state_file = state_file
+
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._last_refill = clock()
+        # pid -> requests in flight
+        self._in_flight = {}
+        self._failures = 0
+        self._successes = 0
+        self._backoff_until = 0
+
+        self._state_fd = None
+        self._state_pid = None
+
+    @property
+    def requests_per_minute(self):
+        return self.rate * 60
+
+    @contextmanager
+    def _state(self):
+        """
+        Holds the limiter's state for an update: the thread lock and, with
+        a state_file, an exclusive flock on the file, whose contents are
+        loaded before and written back after.
+        """
+        with self._lock:
+            if self.state_file is None:
+                yield
+                return
+
+            # flocks are shared with forked children through the
+            # inherited descriptor, so each process opens its own
+            if self._state_pid != os.getpid():
+                self._state_fd = os.open(self.state_file, os.O_RDWR | os.O_CREAT, 0o644)
+                self._state_pid = os.getpid()
+
+            fcntl.flock(self._state_fd, fcntl.LOCK_EX)
+            try:
+                os.lseek(self._state_fd, 0, os.SEEK_SET)
+                content = os.read(self._state_fd, 1 << 16)
+                if content:
+                    state = json.loads(content)
+                    for name in SHARED_STATE:
+                        setattr(self, name, state[name])
+                    self._in_flight = dict((int(pid), n) for pid, n in self._in_flight.items()
+                                           if _alive(int(pid)))
+
+                yield
+
+                content = json.dumps(dict((name, getattr(self, name)) for name in SHARED_STATE))
+                os.lseek(self._state_fd, 0, os.SEEK_SET)
+                os.ftruncate(self._state_fd, 0)
+                os.write(self._state_fd, content)
+            finally:
+                fcntl.flock(self._state_fd, fcntl.LOCK_UN)
+
+    def in_flight(self):
+        return sum(self._in_flight.values())
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        if elapsed > 0:
+            self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+            self._last_refill = now
+
+    def reserve(self):
+        """
+        Try to take a token and a concurrency slot without blocking.
+
+        Returns 0 when the request may go ahead (the caller must then call
+        `release`), otherwise the number of seconds to wait before retrying.
+        """
+        with self._state():
+            now = self._clock()
+            if now < self._backoff_until:
+                return self._backoff_until - now
+
+            self._refill(now)
+            if self.in_flight() >= self.concurrency:
+                # no way to know when a slot frees up, so poll at the token rate
+                return 1.0 / self.rate
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate
+
+            self._tokens -= 1
+            pid = os.getpid()
+            self._in_flight[pid] = self._in_flight.get(pid, 0) + 1
+            return 0
+
+    def acquire(self):
+        """
+        Block until a request may be sent.
+        """
+        while True:
+            wait = self.reserve()
+            if not wait:
+                return
+            self._sleep(wait)
+
+    def release(self, latency=None, ok=True, cached=False):
+        """
+        Give back the concurrency slot taken by `reserve`/`acquire` and
+        adapt the limits to the observed outcome.
+
+        A `cached` response never touched the network, so its token is
+        refunded and it says nothing about how the server is doing.
+        """
+        with self._state():
+            pid = os.getpid()
+            if self._in_flight.get(pid, 0) > 1:
+                self._in_flight[pid] -= 1
+            else:
+                self._in_flight.pop(pid, None)
+
+            if cached:
+                self._tokens = min(self.burst, self._tokens + 1)
+            elif not ok or (latency is not None and latency > self.target_latency):
+                self._decrease(hard=not ok)
+            else:
+                self._increase()
+
+    def _increase(self):
+        self._failures = 0
+        self._successes += 1
+        self.rate = min(self.max_rate, self.rate + self.min_rate / 10.0)
+        # widen concurrency only after a full window of clean responses
+        if self._successes >= self.concurrency * 10 and self.concurrency < self.max_concurrency:
+            self.concurrency += 1
+            self.burst = max(self.burst, self.concurrency)
+            self._successes = 0
+
+    def _decrease(self, hard):
+        self._successes = 0
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.concurrency = max(1, self.concurrency // 2)
+
+        if hard:
+            self._failures += 1
+            self._backoff_until = self._clock() + self.backoff_delay(self._failures)
+
+    def backoff_delay(self, attempt):
+        """
+        Exponential backoff with full jitter for the given (1-based) attempt.
+        """
+        ceiling = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+        return random.uniform(0, ceiling)
+
+    @contextmanager
+    def request(self):
+        """
+        Context manager wrapping a single fetch.
+
+        Yields a dict; set `ok` to False for responses that should count as
+        errors (e.g. 429 or 5xx) and `cached` to True for cache hits.
+        Exceptions raised inside the block count as errors unless `ok` was
+        explicitly set to True (e.g. for a 404, which says nothing about
+        the server being overloaded).
+        """
+        self.acquire()
+        outcome = {'ok': None, 'cached': False}
+        start = self._clock()
+        try:
+            yield outcome
+        except Exception:
+            self.release(self._clock() - start, ok=outcome['ok'] is True)
+            raise
+        self.release(self._clock() - start, ok=outcome['ok'] is not False,
+                     cached=outcome['cached'])
@@ -0,0 +1,106 @@
+"""
+Compact in-memory records for contest results, shared by the scraper and
+the loader.
+
+A contest's results are held as WardRecords with one tuple of candidate
+names per ward and the votes in arrays lined up with it, instead of a
+dict of candidate name -> votes per ward and per precinct. Candidate
+names, ward & precinct ids and jurisdiction strings are interned through
+a StringPool, so the same "ward 1 precinct 1" is stored once no matter how
+many contests it appears in. Use one pool per election and drop it with
+the election's records; without one, nothing is shared between
+records. to_json/from_json convert to and from the election json format,
+which is unchanged.
+"""
+from array import array
+
+# stands in for a candidate missing from a precinct's row, votes are never negative
+MISSING = -1
+
+
+class StringPool(dict):
+    """
+    Interns strings (str or unicode, which the builtin intern can't do).
+    """
+
+    def __call__(self, value):
+        return self.setdefault(value, value)
+
+
+class PrecinctRecord(object):
+    __slots__ = ('precinct', 'jurisdiction', 'votes')
+
+    def __init__(self, precinct, jurisdiction, votes):
+        self.precinct = precinct
+        self.jurisdiction = jurisdiction
+        self.votes = votes
+
+
+class WardRecord(object):
+    __slots__ = ('ward', 'jurisdiction', 'candidates', 'votes', 'precincts')
+
+    def __init__(self, ward, candidates, votes, pool=None):
+        pool = pool if pool is not None else StringPool()
+
+        self.ward = pool(ward)
+        self.jurisdiction = pool("ward %s" % ward)
+        # identical tuples are shared across wards & contests too
+        self.candidates = pool(tuple(pool(candidate) for candidate in candidates))
+        self.votes = array('l', votes)
+        self.precincts = []
+
+    def add_precinct(self, precinct, votes, pool=None):
+        pool = pool if pool is not None else StringPool()
+
+        self.precincts.append(PrecinctRecord(
+            pool(precinct),
+            pool("ward %s precinct %s" % (self.ward, precinct)),
+            array('l', votes)))
+
+    def candidate_totals(self):
+        return zip(self.candidates, self.votes)
+
+    def precinct_totals(self, precinct):
+        return [(candidate, votes) for candidate, votes in zip(self.candidates, precinct.votes)
+                if votes != MISSING]
+
+    def to_json(self):
+        return {
+            'ward': self.ward,
+            'candidate_totals': dict(self.candidate_totals()),
+            'results_by_precinct': [{
+                'precinct': precinct.precinct,
+                'candidate_totals': dict(self.precinct_totals(precinct)),
+            } for precinct in self.precincts]
+        }
+
+    @classmethod
+    def from_json(cls, ward_json, pool=None):
+        candidates = sorted(ward_json['candidate_totals'])
+        ward = cls(ward_json['ward'], candidates,
+                   [ward_json['candidate_totals'][candidate] for candidate in candidates], pool)
+
+        for precinct_json in ward_json['results_by_precinct']:
+            totals = precinct_json['candidate_totals']
+            ward.add_precinct(precinct_json['precinct'],
+                              [totals.get(candidate, MISSING) for candidate in candidates], pool)
+        return ward
+
+
+class ContestRecord(object):
+    __slots__ = ('position', 'wards')
+
+    def __init__(self, position, wards=None):
+        self.position = position
+        self.wards = wards or []
+
+    def to_json(self):
+        return {
+            'position': self.position,
+            'results': [ward.to_json() for ward in self.wards]
+        }
+
+    @classmethod
+    def from_json(cls, contest_json, pool=None):
+        return cls(contest_json['position'],
+                   [WardRecord.from_json(ward_json, pool) for ward_json in contest_json['results']])
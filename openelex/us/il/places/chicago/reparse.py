@@ -0,0 +1,219 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sys
+import urlparse
+
+import requests
+import scrapelib
+
+from .metrics import log, metrics
+from .parse import parse_contest_name, parse_election_names, parse_ward_page
+from .records import ContestRecord, StringPool
+
+MANIFEST_DIR = 'election_manifest'
+CACHE_DIR = '.cache'
+
+# FileCache names a file after the url it holds, with the scheme dropped,
+# '/?:|' turned into ',' and the md5 of the full url appended
+CACHED_WARD_PAGE = re.compile(r',wdlevel3\.asp,(?P<query>[^,]*),(?P<md5>[0-9a-f]{32})$')
+
+# enumerated by the scraper, but not turned into contests
+SUMMARY_CONTESTS = ('REGISTERED VOTERS - TOTAL', 'BALLOTS CAST - ')
+
+
+def cache_key(url):
+    # same key scrapelib's CachingSession uses for a GET
+    return requests.Request(url=url).prepare().url
+
+
+def reparse_contest(task):
+    """
+    Rebuilds the json of one contest from the ward pages in the cache.
+
+    Runs in a worker process, so it takes and returns plain data only.
+    Returns the contest json and the number of ward pages missing from the
+    cache. A contest_name of None is read from the pages' header row (the
+    json's position stays None if none of them has one).
+    """
+    cache_dir, contest_name, links = task
+    cache = scrapelib.FileCache(cache_dir)
+
+    pool = StringPool()
+    contest_record = ContestRecord(contest_name)
+    missing = 0
+    for ward, url in links:
+        resp = cache.get(cache_key(url))
+        if resp is None:
+            missing += 1
+            continue
+
+        if contest_record.position is None:
+            contest_record.position = parse_contest_name(resp.text)
+
+        ward_result = parse_ward_page(resp.text, ward, contest_record.position, url, pool)
+        if ward_result:
+            contest_record.wards.append(ward_result)
+
+    return contest_record.to_json(), missing
+
+
+def manifest_contests(manifest_dir=MANIFEST_DIR):
+    """
+    [(election name, [(contest name, [(ward, url)])])] from the manifests
+    the scraper writes next to the election json.
+    """
+    elections = []
+    for manifest_file in sorted(os.listdir(manifest_dir)):
+        with open(os.path.join(manifest_dir, manifest_file)) as f:
+            manifest = json.load(f)
+        elections.append((manifest['election_name'], manifest['contests']))
+    return elections
+
+
+def cached_contests(scraper, cache_dir=CACHE_DIR):
+    """
+    [(election name, [(None, [(ward, url)])])] for a cache written before
+    the scraper kept manifests.
+
+    Ward pages are found by their cache file names, which start with the
+    page's url, and grouped by the elec_code & race_number in it. Contest
+    names are left for reparse_contest to read from the pages. Election
+    names come from the cached start page, whose option values start with
+    the election code; elections it doesn't list are skipped.
+    """
+    cache = scrapelib.FileCache(cache_dir)
+
+    names = {}
+    start_page = cache.get(cache_key(scraper.start_url))
+    if start_page is not None:
+        for elec_name in parse_election_names(start_page.text):
+            if elec_name[:5].strip().isdigit():
+                names[int(elec_name[:5])] = elec_name
+
+    pages = {}
+    for filename in os.listdir(cache.cache_dir):
+        match = CACHED_WARD_PAGE.search(filename)
+        if not match:
+            continue
+
+        url = cache_key(scraper.base_url + 'en/wdlevel3.asp?' + match.group('query'))
+        params = dict(urlparse.parse_qsl(match.group('query')))
+        try:
+            elec_code, race_number = int(params['elec_code']), int(params['race_number'])
+            ward = params['ward']
+        except (KeyError, ValueError):
+            continue
+        # e.g. a page from another site, or a url too long for the file name
+        if hashlib.md5(url.encode('utf8')).hexdigest() != match.group('md5'):
+            metrics.count('reparse', 'unmatched_pages')
+            continue
+
+        pages.setdefault(elec_code, {}).setdefault(race_number, []).append((ward, url))
+
+    elections = []
+    for elec_code, races in sorted(pages.items()):
+        if elec_code not in names:
+            log.warning("no election name for elec_code %s in the cached start page, skipping it", elec_code)
+            metrics.count('reparse', 'elections_skipped')
+            continue
+
+        contests = [(None, sorted(links, key=lambda link: int(link[0]) if link[0].isdigit() else link[0]))
+                    for _, links in sorted(races.items())]
+        elections.append((names[elec_code], contests))
+    return elections
+
+
+def reparse(manifest_dir=MANIFEST_DIR, cache_dir=CACHE_DIR, processes=None, elections=None,
+            base_url=None, force=False):
+    """
+    Regenerates election json from the scraper's cache alone, without any
+    network access, spreading the contests over a pool of processes.
+
+    Elections are found through the manifests the scraper writes next to
+    the election json or, when there are none (e.g. a cache from before
+    manifests), in the cache itself (see cached_contests), which needs the
+    `base_url` the pages were scraped from if it isn't the default.
+    `elections` optionally restricts the run to those election names.
+    Ward pages missing from the cache are counted; that always includes
+    pages the scraper had to fetch with fallback_get, which doesn't cache.
+    An election with missing pages is left as it is, rather than replaced
+    by a partial one, unless `force` is set. Returns a dict of election
+    name -> number of missing pages.
+    """
+    from .scraper import Scraper
+    scraper = Scraper(base_url=base_url) if base_url else Scraper()
+
+    if os.path.isdir(manifest_dir) and os.listdir(manifest_dir):
+        found = manifest_contests(manifest_dir)
+    else:
+        log.info("no manifests in %s, looking for ward pages in %s", manifest_dir, cache_dir)
+        found = cached_contests(scraper, cache_dir)
+
+    found = [(elec_name, contests) for elec_name, contests in found
+             if elections is None or elec_name in elections]
+
+    tasks = [(cache_dir, contest_name, links)
+             for _, contests in found
+             for contest_name, links in contests]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        # imap keeps the results in task order, so each election's
+        # contests come back together and in their original order
+        contest_results = pool.imap(reparse_contest, tasks, chunksize=4)
+
+        missing_pages = {}
+        for elec_name, contests in found:
+            contest_records = []
+            strings = StringPool()
+            missing_pages[elec_name] = 0
+            for _ in contests:
+                contest_json, missing = next(contest_results)
+                missing_pages[elec_name] += missing
+
+                position = contest_json['position']
+                if position is None or any(summary in position for summary in SUMMARY_CONTESTS):
+                    continue
+                contest_records.append(ContestRecord.from_json(contest_json, strings))
+
+            metrics.count('reparse', 'missing_pages', missing_pages[elec_name], election=elec_name)
+            if missing_pages[elec_name] and not force:
+                log.warning("%s: %d ward pages missing from the cache, not rewriting its json",
+                            elec_name, missing_pages[elec_name])
+                metrics.count('reparse', 'elections_skipped')
+                continue
+
+            scraper.write_election_json(elec_name, contest_records)
+            metrics.count('reparse', 'contests', len(contest_records), election=elec_name)
+    finally:
+        pool.close()
+        pool.join()
+
+    return missing_pages
+
+
+def main(argv=None):
+    """
+    python -m openelex.us.il.places.chicago.reparse [--force] [processes]
+
+    Elections with ward pages missing from the cache are only rewritten,
+    without those pages, with --force.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    force = '--force' in argv
+    argv = [arg for arg in argv if arg != '--force']
+    processes = int(argv[0]) if argv else None
+
+    for elec_name, missing in sorted(reparse(processes=processes, force=force).items()):
+        if missing:
+            print "%s: %d ward pages missing from the cache, %s" % (
+                elec_name, missing, 'rewritten without them' if force else 'left as it was')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
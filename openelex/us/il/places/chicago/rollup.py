@@ -0,0 +1,123 @@
+"""
+Precomputed ward and citywide vote totals.
+
+Rather than aggregating precinct RawResult/Result rows every time ward or
+citywide totals are needed, the loader (stage 'raw') and
+CreateResultsTransform (stage 'result') keep a small rollup collection up
+to date: one row per election x office x geography x candidate, where the
+geography is a ward ('municipal_district', e.g. 'ward 1') or the whole city
+('place', 'Chicago'). Offices are keyed by the raw office string, as on
+RawResult. An election's rollup is replaced whenever it's loaded or
+transformed again, e.g.
+
+    RollupStore().totals(election_id, 'mayor')
+
+gives the citywide totals for every mayoral candidate.
+"""
+from .lazy import LazyModule
+from .metrics import metrics
+
+models = LazyModule('openelex.models')
+
+COLLECTION = 'chicago_rollups'
+PLACE = 'Chicago'
+
+WARD_LEVEL = 'municipal_district'
+CITY_LEVEL = 'place'
+
+
+class Rollup(dict):
+    """
+    Accumulates (office, reporting level, jurisdiction, full name) -> votes
+    for one election.
+    """
+
+    def add(self, office, ward_jurisdiction, full_name, votes):
+        for key in ((office, WARD_LEVEL, ward_jurisdiction, full_name),
+                    (office, CITY_LEVEL, PLACE, full_name)):
+            self[key] = self.get(key, 0) + votes
+
+    def add_wards(self, office, wards):
+        """
+        Adds the ward totals of a contest's WardRecords.
+        """
+        for ward in wards:
+            for full_name, votes in ward.candidate_totals():
+                self.add(office, ward.jurisdiction, full_name, votes)
+
+    def documents(self, election_id, stage):
+        return [{
+            'election_id': election_id,
+            'stage': stage,
+            'office': office,
+            'reporting_level': reporting_level,
+            'jurisdiction': jurisdiction,
+            'full_name': full_name,
+            'votes': votes,
+        } for (office, reporting_level, jurisdiction, full_name), votes in self.items()]
+
+
+class RollupStore(object):
+
+    def __init__(self, collection=None):
+        self._collection = collection
+        self._indexed = False
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            # lives next to the results, in the database the models use
+            self._collection = models.RawResult._get_db()[COLLECTION]
+        return self._collection
+
+    def ensure_index(self):
+        if not self._indexed:
+            self.collection.create_index([('election_id', 1), ('stage', 1), ('office', 1),
+                                          ('reporting_level', 1), ('jurisdiction', 1)],
+                                         name='chicago_rollup_lookup', background=True)
+            self._indexed = True
+
+    def replace(self, election_id, stage, rollup):
+        """
+        Replaces the election's rollup for a stage with `rollup`.
+        """
+        self.ensure_index()
+        with metrics.timer('rollup', 'replace', rollup_stage=stage):
+            self.collection.remove({'election_id': election_id, 'stage': stage})
+            documents = rollup.documents(election_id, stage)
+            if documents:
+                self.collection.insert(documents)
+        metrics.count('rollup', 'rows', len(documents), rollup_stage=stage)
+
+    def remove(self, election_ids, stage):
+        self.collection.remove({'election_id': {'$in': list(election_ids)}, 'stage': stage})
+
+    def totals(self, election_id, office, jurisdiction=PLACE, stage='result'):
+        """
+        [(full name, votes)] for an office in one ward (e.g. 'ward 1') or,
+        by default, the whole city, most votes first.
+        """
+        reporting_level = CITY_LEVEL if jurisdiction == PLACE else WARD_LEVEL
+        rows = self.collection.find({
+            'election_id': election_id,
+            'stage': stage,
+            'office': office,
+            'reporting_level': reporting_level,
+            'jurisdiction': jurisdiction,
+        }, {'full_name': 1, 'votes': 1})
+        return sorted(((row['full_name'], row['votes']) for row in rows), key=lambda row: -row[1])
+
+    def wards(self, election_id, office, stage='result'):
+        """
+        {ward jurisdiction: [(full name, votes)]} for every ward that voted
+        on an office.
+        """
+        wards = {}
+        for row in self.collection.find({
+                'election_id': election_id,
+                'stage': stage,
+                'office': office,
+                'reporting_level': WARD_LEVEL,
+        }, {'jurisdiction': 1, 'full_name': 1, 'votes': 1}):
+            wards.setdefault(row['jurisdiction'], []).append((row['full_name'], row['votes']))
+        return wards
@@ -6,7 +6,33 @@ import re
 from dateutil.parser import parse
 import requests
 
-class Scraper(scrapelib.Scraper):
+from .metrics import log, metrics
+from .parse import parse_election_names, parse_ward_page
+from .pool import PooledAdapter
+from .ratelimit import AdaptiveRateLimiter
+from .records import ContestRecord, StringPool, WardRecord
+from .workqueue import default_worker_id
+
+# responses that mean the server wants us to slow down
+THROTTLE_STATUS_CODES = set([429, 500, 502, 503, 504])
+
+class RateLimitedSession(requests.Session):
+    """
+    Waits on `self.rate_limiter` around every request that goes out over
+    the network. Scraper puts it below scrapelib's caching, so responses
+    served from the cache never wait for a token.
+    """
+
+    def request(self, method, url, **kwargs):
+        with self.rate_limiter.request() as outcome:
+            with metrics.timer('scrape', 'fetch', method=method.upper()):
+                resp = super(RateLimitedSession, self).request(method, url, **kwargs)
+            outcome['ok'] = resp.status_code not in THROTTLE_STATUS_CODES
+        return resp
+
+
+# scrapelib.Scraper -> caching -> (disabled) throttling & retries -> RateLimitedSession
+class Scraper(scrapelib.Scraper, RateLimitedSession):
     def __init__(   self,
                     raise_errors=True,
                     requests_per_minute=100,
@@ -15,81 +41,250 @@ class Scraper(scrapelib.Scraper):
                     retry_wait_seconds=2,
                     header_func=None,
                     url_pattern=None,
-                    string_on_page=None ):
-
+                    string_on_page=None,
+                    rate_limiter=None,
+                    rate_limit_file=None,
+                    pool_connections=10,
+                    pool_maxsize=10,
+                    keep_alive=True,
+                    base_url='http://www.chicagoelections.com/' ):
+
+        # throttling & retries are handled by the rate limiter (see
+        # RateLimitedSession and request), so scrapelib's own versions are
+        # switched off. The limiter is per-process unless processes share a
+        # rate_limit_file, see AdaptiveRateLimiter.
         super(Scraper, self).__init__(  raise_errors=raise_errors,
-                                        requests_per_minute=requests_per_minute,
-                                        retry_attempts=retry_attempts,
+                                        requests_per_minute=0,
+                                        retry_attempts=0,
                                         retry_wait_seconds=retry_wait_seconds,
                                         header_func=header_func )
 
-        self.base_url = 'http://www.chicagoelections.com/'
+        if rate_limiter is None:
+            rate_limiter = AdaptiveRateLimiter( requests_per_minute=requests_per_minute,
+                                                backoff_base=retry_wait_seconds,
+                                                state_file=rate_limit_file )
+        self.rate_limiter = rate_limiter
+        self.max_retries = retry_attempts
+
+        # one keep-alive connection pool shared by every fetch path
+        self.http_adapter = PooledAdapter(  pool_connections=pool_connections,
+                                            pool_maxsize=pool_maxsize,
+                                            keep_alive=keep_alive )
+        self.mount('http://', self.http_adapter)
+        self.mount('https://', self.http_adapter)
+
+        self.base_url = base_url
+        self.start_url = self.base_url + 'en/election3.asp'
 
         cache_dir = '.cache'
         self.cache_storage = scrapelib.FileCache(cache_dir)
-    
-    def election_urls(self):
-        start_url = self.base_url + 'en/election3.asp'
-
-        r = self.get(start_url)
-        tree = lxml.html.fromstring(r.text)
-
-        elec_options = tree.xpath("//table[@class='maincontent']//select/option/@value")
-        for elec_name in elec_options:
-            print 'ELECTION', elec_name
-            post_data = {
-                'D3' : elec_name,
-                'flag1' : '1',
-                'B1' : 'View'
-                }
-            
-            contests = []
 
-            _, result = self.urlretrieve(start_url, method='POST', body=post_data)
+    def request(self, method, url, **kwargs):
+        """
+        Every request made through scrapelib (get, urlretrieve, ...) that
+        isn't answered from the cache waits on the rate limiter, which
+        hears back how the server responded. Connection errors, timeouts
+        and throttling responses are retried after the limiter's jittered
+        exponential backoff.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                resp = super(Scraper, self).request(method, url, **kwargs)
+                self._count_response(resp)
+                return resp
+            except (requests.HTTPError, requests.ConnectionError, requests.Timeout) as e:
+                metrics.count('scrape', 'fetch_errors')
+                if isinstance(e, scrapelib.HTTPError):
+                    retryable = e.response.status_code in THROTTLE_STATUS_CODES
+                else:
+                    retryable = not isinstance(e, requests.exceptions.SSLError)
+                if not retryable or attempt > self.max_retries:
+                    raise
+                metrics.count('scrape', 'retries')
+
+    def _count_response(self, resp):
+        metrics.count('scrape', 'bytes', len(resp.content))
+        if getattr(resp, 'fromcache', False):
+            metrics.count('scrape', 'cache_hits')
+
+    def fallback_get(self, url):
+        """
+        Plain GET, used when urlretrieve fails. Skips scrapelib's caching
+        and error handling but is still throttled and goes over the
+        pooled connections. Pages fetched this way are never cached, so
+        an offline reparse always reports them as missing.
+        """
+        with self.rate_limiter.request() as outcome:
+            with metrics.timer('scrape', 'fetch', method='GET', fallback=True):
+                result = requests.Session.request(self, 'GET', url)
+            outcome['ok'] = result.status_code not in THROTTLE_STATUS_CODES
+        self._count_response(result)
+        return result
+
+    def connection_stats(self):
+        return self.http_adapter.connection_stats()
+
+    def election_names(self):
+        r = self.get(self.start_url)
+        return parse_election_names(r.text)
+
+    def contest_names(self, elec_name):
+        """
+        Returns the url that contests of an election are posted to, along
+        with the names of those contests.
+        """
+        post_data = {
+            'D3' : elec_name,
+            'flag1' : '1',
+            'B1' : 'View'
+            }
+
+        _, result = self.urlretrieve(self.start_url, method='POST', body=post_data)
+        tree = lxml.html.fromstring(result.text)
+
+        return result.url, tree.xpath("//table[@class='maincontent']//select/option/@value")
+
+    def contest_links(self, contest_page_url, contest_name):
+        """
+        Returns (ward, url) pairs for the ward results pages of a contest,
+        or None if the contest could not be retrieved or parsed.
+        """
+        post_data = {
+            'D3' : contest_name,
+            'flag' : '1',
+            'B1' : '  View The Results   '
+            }
+
+        try:
+            _, result = self.urlretrieve(contest_page_url, method='POST', body=post_data)
+        except:
+            log.warning("ERROR: UNABLE TO RETRIEVE RESULT - skipping contest: %s, "
+                        "request url: %s, request post data: %s", contest_name, contest_page_url, post_data)
+            metrics.count('scrape', 'contests_skipped')
+            return None
+
+        try:
             tree = lxml.html.fromstring(result.text)
-            contest_options = tree.xpath("//table[@class='maincontent']//select/option/@value")
-            for contest_name in contest_options:
-                post_data = {
-                    'D3' : contest_name,
-                    'flag' : '1',
-                    'B1' : '  View The Results   '
-                    }
-
-                try:
-                    _, result = self.urlretrieve(result.url, method='POST', body=post_data)
-                    contest_urls = []
-                    ballots_cast = None
-                    registered_voters = None
-
-                    try:
-                        tree = lxml.html.fromstring(result.text)
-                        links = tree.xpath("//table//tr//td[1]//a")
-                        if 'REGISTERED VOTERS - TOTAL' in contest_name:
-                            registered_voters = [(link.text, self.base_url+'en/'+link.attrib['href']) for link in links]
-                        elif 'BALLOTS CAST - ' in contest_name:
-                            ballots_cast = [(link.text, self.base_url+'en/'+link.attrib['href']) for link in links]
-                        else:
-                            for link in links:
-                                contest_urls.append((link.text, self.base_url+'en/'+link.attrib['href']))
-                            contests.append((contest_name, contest_urls))
-                    except:
-                        # TO DO - figure out what's going on here
-                        print "*** ERROR: UNABLE TO PARSE HTML ***"
-                        print "SKIPPING CONTEST: %s" % contest_name
-                        print "request url: %s" % result.url
-                        print "request post data: %s" %post_data
-                        print "***********************************\n"
-
-                except:
-                    print "*** ERROR: UNABLE TO RETRIEVE RESULT ***"
-                    print "SKIPPING CONTEST: %s" % contest_name
-                    print "request url: %s" % result.url
-                    print "request post data: %s" %post_data
-                    print "***********************************\n"
+            links = tree.xpath("//table//tr//td[1]//a")
+            return [(link.text, self.base_url+'en/'+link.attrib['href']) for link in links]
+        except:
+            # TO DO - figure out what's going on here
+            log.warning("ERROR: UNABLE TO PARSE HTML - skipping contest: %s, "
+                        "request url: %s, request post data: %s", contest_name, result.url, post_data)
+            metrics.count('scrape', 'contests_skipped')
+            return None
+
+    def election_urls(self):
+        for elec_name in self.election_names():
+            log.info('ELECTION %s', elec_name)
+
+            contests = []
+            registered_voters = None
+            ballots_cast = None
+
+            with metrics.context(election=elec_name), metrics.timer('scrape', 'enumerate'):
+                contest_page_url, contest_options = self.contest_names(elec_name)
+                for contest_name in contest_options:
+                    links = self.contest_links(contest_page_url, contest_name)
+                    if links is None:
+                        continue
+
+                    if 'REGISTERED VOTERS - TOTAL' in contest_name:
+                        registered_voters = links
+                    elif 'BALLOTS CAST - ' in contest_name:
+                        ballots_cast = links
+                    else:
+                        contests.append((contest_name, links))
 
             yield elec_name, contests, registered_voters, ballots_cast
 
-    def make_elections_json(self, elec_name, contests, registered_voters, ballots_cast):
+    def enqueue(self, queue):
+        """
+        Seeds a WorkQueue with one unit per election that has not been
+        scraped yet. Returns the number of elections enqueued.
+        """
+        elec_names = [elec_name for elec_name in self.election_names()
+                      if not os.path.exists(self.election_filename(elec_name))]
+        for elec_name in elec_names:
+            queue.add('election', elec_name)
+
+        return len(elec_names)
+
+    def work(self, queue, worker=None, assemble=True):
+        """
+        Claims and processes units from a WorkQueue until it is empty,
+        writing the json of every election whose units are all finished
+        unless `assemble` is False (e.g. the queue's server does that).
+        """
+        worker = worker or default_worker_id()
+
+        while True:
+            unit = queue.claim(worker)
+            # checked after every claim, which may have given up on the last
+            # unfinished unit of any election
+            if assemble:
+                self.assemble_ready(queue)
+            if unit is None:
+                break
+
+            try:
+                with metrics.context(election=unit['election'], contest=unit['contest'] or None), \
+                        metrics.timer('scrape', 'unit', unit=unit['kind']):
+                    result = self.process_unit(queue, unit)
+            except Exception as e:
+                log.warning("ERROR: UNIT FAILED (attempt %d) - %s %s %s %s: %r", unit['attempts'],
+                            unit['kind'], unit['election'], unit['contest'], unit['ward'], e)
+                metrics.count('scrape', 'unit_failures', unit=unit['kind'])
+                queue.fail(unit, worker, repr(e))
+            else:
+                queue.complete(unit, worker, result)
+
+    def assemble_ready(self, queue):
+        """
+        Writes the json of every election in the queue that is ready to be
+        assembled and that no other worker has claimed the assembly of.
+        """
+        for election in queue.assemblable():
+            if not queue.claim_assembly(election):
+                continue
+            try:
+                self.write_manifest(election, queue.contest_links(election))
+                pool = StringPool()
+                self.write_election_json(election, [
+                    ContestRecord(contest_name, [WardRecord.from_json(result, pool) for result in results])
+                    for contest_name, results in queue.contest_results(election)])
+            except:
+                queue.unassemble(election)
+                raise
+
+    def process_unit(self, queue, unit):
+        if unit['kind'] == 'election':
+            log.info('ELECTION %s', unit['election'])
+            contest_page_url, contest_options = self.contest_names(unit['election'])
+            for position, contest_name in enumerate(contest_options):
+                if 'REGISTERED VOTERS - TOTAL' in contest_name or 'BALLOTS CAST - ' in contest_name:
+                    continue
+                queue.add('contest', unit['election'], contest_name,
+                          url=contest_page_url, position=position)
+
+        elif unit['kind'] == 'contest':
+            log.info('  CONTEST %s', unit['contest'])
+            links = self.contest_links(unit['url'], unit['contest'])
+            if links is None:
+                # leave the unit to be retried, and skipped if it keeps failing
+                raise ValueError("unable to retrieve contest %s" % unit['contest'])
+            for position, (ward, url) in enumerate(links):
+                queue.add('ward', unit['election'], unit['contest'], ward, url,
+                          contest_position=unit['position'], position=position)
+
+        elif unit['kind'] == 'ward':
+            html = self.ward_page(unit['url'], unit['contest'])
+            ward_result = parse_ward_page(html, unit['ward'], unit['contest'], unit['url'])
+            return ward_result.to_json() if ward_result else None
+
+    def election_slug(self, elec_name):
         # slug = re.sub(r'[^0-9a-z]+', '_', elec_name.lower().strip())
         elec_name = elec_name[5:]
         parts = elec_name.split(' - ')
@@ -121,130 +316,78 @@ class Scraper(scrapelib.Scraper):
         slug_parts.append(re.sub(r'[^0-9a-z]+', '_', name.lower().strip()))
         slug_parts.append('precinct')
 
-        slug = '__'.join(slug_parts)
+        return '__'.join(slug_parts)
 
-        filename = 'election_json/'+slug+'.json'
+    def election_filename(self, elec_name):
+        return 'election_json/'+self.election_slug(elec_name)+'.json'
 
-        if not os.path.exists(filename):
+    def manifest_filename(self, elec_name):
+        return 'election_manifest/'+self.election_slug(elec_name)+'.json'
 
-            election_json = {
-                'election_name': elec_name,
-                'date': None,
-                'contests': [self.make_contest_json(contest_name, contest_urls) for contest_name, contest_urls in contests]
-            }
+    def write_manifest(self, elec_name, contests):
+        """
+        Records the ward page urls of every contest of an election. The
+        enumeration POSTs aren't cached, so this is what lets the ward pages
+        in the cache be re-parsed offline (see reparse.py).
+        """
+        if not os.path.isdir('election_manifest'):
+            os.makedirs('election_manifest')
 
-            with open(filename, 'w+') as outfile:
-                json.dump(election_json, outfile, indent=4)
+        manifest = {
+            'election_name': elec_name,
+            'contests': contests
+        }
 
+        with open(self.manifest_filename(elec_name), 'w+') as outfile:
+            json.dump(manifest, outfile, indent=4)
 
+    def make_elections_json(self, elec_name, contests, registered_voters, ballots_cast):
+        filename = self.election_filename(elec_name)
+        self.write_manifest(elec_name, contests)
+
+        if not os.path.exists(filename):
+            # shared by the election's contests, and dropped with them
+            pool = StringPool()
+            with metrics.context(election=elec_name):
+                contest_records = [self.make_contest_json(contest_name, contest_urls, pool) for contest_name, contest_urls in contests]
+            self.write_election_json(elec_name, contest_records)
+
+    def write_election_json(self, elec_name, contest_records):
+        if not os.path.isdir('election_json'):
+            os.makedirs('election_json')
+
+        election_json = {
+            'election_name': elec_name[5:],
+            'date': None,
+            'contests': [contest.to_json() for contest in contest_records]
+        }
+
+        with open(self.election_filename(elec_name), 'w+') as outfile:
+            json.dump(election_json, outfile, indent=4)
 
     def make_summary_json(self, summary_urls):
         return {}
 
-    def make_contest_json(self, contest_name, contest_urls):
+    def ward_page(self, url, contest_name):
+        try:
+            _, result = self.urlretrieve(url)
+        except:
+            log.warning("NOTE: using requests instead of urlretrieve b/c urlretrieve failed - "
+                        "ward results url: %s, contest: %s", url, contest_name)
+            metrics.count('scrape', 'fallback_fetches')
+            result = self.fallback_get(url)
 
-        print '  CONTEST', contest_name
+        return result.text
 
-        contest_json = {
-            'position': contest_name,
-            'results': []
-        }
-        for ward, url in contest_urls:
+    def make_contest_json(self, contest_name, contest_urls, pool=None):
 
-            try:
-                _, result = self.urlretrieve(url)
-            except:
-                print "-"*60
-                print "NOTE: using requests instead of urlretrieve b/c urlretrieve failed"
-                print "ward results url: %s" % url
-                print "contest: %s" % contest_name
-                print "-"*60
-                result = requests.get(url)
-
-            if 'ward, election selected or contest was bad' in result.text.lower():
-                print "*"*60
-                print "ERROR: BROKEN RESULTS PAGE"
-                print "url: %s" % url
-                print "*"*60
-            else:
-
-                tree = lxml.html.fromstring(result.text)
+        log.info('  CONTEST %s', contest_name)
 
-                header_td_list = tree.xpath("//table[1]//tr[2]//td")
-                tbl_header = [td.xpath("string(.)") for td in header_td_list]
-                num_cols = len(tbl_header)
+        contest_record = ContestRecord(contest_name)
+        with metrics.context(contest=contest_name), metrics.timer('scrape', 'contest'):
+            for ward, url in contest_urls:
+                ward_result = parse_ward_page(self.ward_page(url, contest_name), ward, contest_name, url, pool)
+                if ward_result:
+                    contest_record.wards.append(ward_result)
 
-                # finding the position of the last row of results (the row w/ totals)
-                # b/c sometimes there are extra non-result rows in the table
-                rows = tree.xpath("//table[1]//tr")
-                first_col_str = [tr.xpath("td")[0].xpath("string(.)") if tr.xpath("td") else None for tr in rows]
-                if 'Total' in first_col_str:
-                    idx_total_row = list(reversed(first_col_str)).index('Total')
-                    precinct_td_list = tree.xpath("//table[1]//tr[position() > 2 and not(position() > last()-%s)]//td" % (idx_total_row+1))
-                    precinct_data = [precinct_td_list[i:i+num_cols] for i in range(0, len(precinct_td_list), num_cols)]
-                else:
-                    precinct_td_list = tree.xpath("//table[1]//tr[position() > 2]//td")
-                    precinct_data = [precinct_td_list[i:i+num_cols] for i in range(0, len(precinct_td_list), num_cols)]
-
-                if precinct_data:
-                    totals = []
-                    # loop through columns
-                    for i in range(0, len(precinct_data[0])):
-                        col_total = 0
-                        # loop through rows to get the sum of all values in a column
-                        for row in precinct_data:
-                            try:
-                                parsed_num = int(row[i].xpath("string(.)"))
-                                col_total += parsed_num
-                            except:
-                                # sometimes these will be percentages but these will be ignored later anyways
-                                col_total = None
-                        totals.append(col_total)
-
-                    # TO-DO: distinguish between voting on candidates vs voting on Y/N vote?
-                    if len(tbl_header) > 2: # more than one candidate running
-                        candidates = tbl_header[2::2]
-                        votes_totals = totals[2::2]
-                    else: # only one candidate
-                        candidates = [tbl_header[1]]
-                        votes_totals = [totals[1]]
-
-                    results_by_precinct = []
-                    for row in precinct_data:
-                        row_string = [td.xpath("string(.)") for td in row]
-                        precinct = row_string[0]
-                        
-                        precinct_result = {
-                            'precinct': precinct,
-                            'candidate_totals': {}
-                        }
-                        if num_cols > 2:
-                            votes_precinct = row_string[2::2]
-                        else: # only one candidate
-                            votes_precinct = [row_string[1]]
-
-                        for candidate, vote in zip(candidates, votes_precinct):
-                            precinct_result['candidate_totals'][candidate] = int(vote)
-
-                        results_by_precinct.append(precinct_result)
-
-                    candidate_totals = {}
-                    for candidate, votes_total in zip(candidates, votes_totals):
-                        candidate_totals[candidate] = int(votes_total)
-
-                    ward_result = {
-                        'ward': ward,
-                        'candidate_totals': candidate_totals,
-                        'results_by_precinct': results_by_precinct
-                    }
-
-                    contest_json['results'].append(ward_result)
-                else:
-                    print "*"*60
-                    print "ERROR: MISSING PRECINCT LEVEL DATA"
-                    print "contest: %s" % contest_name
-                    print "ward: %s" % ward
-                    print "*"*60
-
-        return contest_json 
-        
\ No newline at end of file
+        return contest_record
@@ -1,10 +1,18 @@
+from contextlib import contextmanager
 from datetime import datetime
 import re
-import probablepeople as pp
+import time
 
 from openelex.base.transform import Transform, registry
-from openelex.models import Candidate, Contest, Office, Party, RawResult, Result
 
+from ..lazy import LazyModule
+from ..metrics import log, metrics
+from ..rollup import WARD_LEVEL, Rollup, RollupStore
+from .profiling import active_profiler, call_site, query_shape
+
+# loaded on first use, so registering the transforms stays cheap
+pp = LazyModule('probablepeople')
+models = LazyModule('openelex.models')
 STATE = 'IL'
 PLACE = 'Chicago'
 COUNTY = 'Cook'
@@ -23,6 +31,8 @@ candidate_fields = meta_fields + ['full_name', 'given_name',
                                   'family_name', 'additional_name']
 result_fields = meta_fields + ['reporting_level', 'jurisdiction',
                                'votes', 'total_votes', 'vote_breakdowns']
+# what identifies an office, see _office_spec
+office_fields = ['name', 'state', 'district', 'place', 'county']
 
 
 class BaseTransform(Transform):
@@ -42,8 +52,70 @@ class BaseTransform(Transform):
         self._office_cache = {}
         self._contest_cache = {}
 
+    @contextmanager
+    def _query(self, op, fields=()):
+        """
+        Wraps a datastore call, recording it as a 'query' timer labelled
+        with the transform and the kind of call (e.g. 'Office.get').
+
+        When query profiling is on (see profiling.py), the call is also
+        recorded with its call site and the fields it filters on, and
+        checked against the transform's query budget.
+        """
+        profiler = active_profiler()
+        if profiler:
+            # 0 is this generator, 1 is contextlib's __enter__
+            site = call_site(2)
+
+        start = time.time()
+        try:
+            with metrics.timer('transform', 'query', transform=self._transform_name(), op=op):
+                yield
+        finally:
+            # calls that raise (e.g. DoesNotExist) still hit the datastore
+            if profiler:
+                profiler.record(self._transform_name(), site, query_shape(op, fields), time.time() - start)
+
+    def _scan(self, op, queryset, fields=()):
+        """
+        Iterates over a queryset, recording the whole scan as one query
+        like _query does.
+
+        Querysets are lazy, so building one costs nothing; the datastore
+        work happens while iterating, as the cursor fetches its batches.
+        Only the time spent getting the next document is counted, not the
+        caller's loop body.
+        """
+        profiler = active_profiler()
+        if profiler:
+            # 0 is this generator, 1 is the loop iterating over it
+            site = call_site(1)
+
+        seconds = 0.0
+        documents = iter(queryset)
+        try:
+            while True:
+                start = time.time()
+                try:
+                    document = next(documents)
+                except StopIteration:
+                    break
+                finally:
+                    seconds += time.time() - start
+                yield document
+        finally:
+            metrics.record('transform', 'query', seconds, 'timer', transform=self._transform_name(), op=op)
+            if profiler:
+                profiler.record(self._transform_name(), site, query_shape(op, fields), seconds)
+
+    def _transform_name(self):
+        return getattr(self, 'name', None) or self.__class__.__name__
+
+    def _count(self, name, value=1):
+        metrics.count('transform', name, value, transform=self._transform_name())
+
     def get_raw_results(self):
-        return RawResult.objects.filter(state=STATE, place=PLACE).no_cache()
+        return models.RawResult.objects.filter(state=STATE, place=PLACE).no_cache()
 
     def get_judge_candidate_fields(self, raw_result):
         fields = self._get_fields(raw_result, candidate_fields)
@@ -66,11 +138,8 @@ class BaseTransform(Transform):
             name_parts, name_type = pp.tag(full_name)
 
             if name_type != 'Person':
-                print "***************************"
-                print "NOT A PERSON:", fields['full_name']
-                print "fields:", fields
-                print "tagged name:", name_parts
-                print "***************************"
+                log.warning("NOT A PERSON: %s - fields: %s, tagged name: %s",
+                            fields['full_name'], fields, name_parts)
                 fields['full_name'] = full_name
                 return fields
 
@@ -84,9 +153,7 @@ class BaseTransform(Transform):
             fields['full_name'] = full_name
 
         except pp.RepeatedLabelError:
-            print "***************************"
-            print "UNABLE TO TAG:", full_name
-            print "***************************"
+            log.warning("UNABLE TO TAG: %s", full_name)
             fields['full_name'] = full_name
 
         return fields
@@ -112,12 +179,13 @@ class BaseTransform(Transform):
                 fields.pop('source')
                 try:
                     try:
-                        contest = Contest.objects.filter(**fields)[0]
+                        with self._query('Contest.filter', fields):
+                            contest = models.Contest.objects.filter(**fields)[0]
                     except IndexError:
-                        contest = Contest.objects.get(**fields)
+                        with self._query('Contest.get', fields):
+                            contest = models.Contest.objects.get(**fields)
                 except Exception:
-                    print fields
-                    print "\n"
+                    log.error("unable to get contest: %s", fields)
                     raise
                 self._contest_cache[key] = contest
                 return contest
@@ -134,26 +202,107 @@ class BaseTransform(Transform):
         else:
             return None
 
+    def prepare_offices(self):
+        """
+        Upserts the office for every distinct raw office string in one bulk
+        operation and seeds the office cache with them, so the per raw
+        result loops don't get or save offices one at a time.
+
+        The Office collection is shared with other loaders and has no
+        unique index, so it may already hold duplicates of an office, and
+        concurrent runs can both insert one. The offices are read back
+        after the upserts and duplicates are logged, with every run using
+        the oldest of them (see _pick_office).
+        """
+        with self._query('RawResult.distinct', ['state', 'place']):
+            raw_offices = models.RawResult.objects.filter(state=STATE, place=PLACE).distinct('office')
+
+        office_queries = {}
+        for raw_office in raw_offices:
+            clean_name = self._clean_office_name(raw_office)
+            if clean_name:
+                office_query = self._make_office_query(clean_name, raw_office)
+                office_queries[models.Office.make_key(**office_query)] = office_query
+
+        if not office_queries:
+            return
+
+        # the specs all name the same fields, so none of them can match
+        # another's office and the upserts don't depend on their order
+        bulk = models.Office._get_collection().initialize_unordered_bulk_op()
+        for office_query in office_queries.values():
+            office = models.Office(**office_query)
+            office.validate()
+            document = office.to_mongo()
+            spec = {}
+            for field, value in self._office_spec(office_query).items():
+                db_field = models.Office._fields[field].db_field if field in models.Office._fields else field
+                spec[db_field] = value
+                document.pop(db_field, None)
+            document.pop('_id', None)
+            # an empty $setOnInsert is an error, the spec alone makes the office then
+            update = {'$setOnInsert': document} if document else {'$set': spec}
+            bulk.find(spec).upsert().update_one(update)
+
+        with self._query('Office.bulk_upsert', office_fields):
+            upserted = bulk.execute()['nUpserted']
+        self._count('offices_upserted', upserted)
+
+        states = set(office_query['state'] for office_query in office_queries.values())
+        with self._query('Office.filter', ['state']):
+            offices = list(models.Office.objects.filter(state__in=list(states)))
+
+        for key, office_query in office_queries.items():
+            spec = self._office_spec(office_query)
+            matches = [office for office in offices
+                       if all(getattr(office, field, None) == value for field, value in spec.items())]
+            if matches:
+                self._office_cache[key] = self._pick_office(spec, matches)
+
+    def _pick_office(self, spec, offices):
+        """
+        The office to use out of those matching a spec: the oldest, so that
+        runs seeing the same duplicates all settle on the same office.
+        """
+        if len(offices) > 1:
+            log.warning("%d duplicate offices for %s: %s", len(offices), spec,
+                        ', '.join(str(office.pk) for office in offices))
+            self._count('office_duplicates', len(offices) - 1)
+        return min(offices, key=lambda office: office.pk)
+
+    def _office_spec(self, office_query):
+        """
+        The office query with every one of office_fields, those it leaves
+        out as None, so that e.g. a county office and the office of the same
+        name without a county are never mistaken for one another.
+        """
+        spec = dict((field, None) for field in office_fields)
+        spec.update(office_query)
+        return spec
+
     def _get_or_make_office(self, raw_result):
         clean_name = self._clean_office_name(raw_result.office)
 
         if clean_name:
 
-            office_query = self._make_office_query(clean_name, raw_result)
-            key = Office.make_key(**office_query)
+            office_query = self._make_office_query(clean_name, raw_result.office)
+            key = models.Office.make_key(**office_query)
 
             try:
                 return self._office_cache[key]
             except KeyError:
-                try:
-                    office = Office.objects.get(**office_query)
-                    self._office_cache[key] = office
-                    return office
-                except Office.DoesNotExist:
-                    office = Office(**office_query)
-                    office.save()
-                    self._office_cache[key] = office
-                    return office
+                spec = self._office_spec(office_query)
+                with self._query('Office.filter', office_fields):
+                    offices = list(models.Office.objects.filter(**spec))
+                if not offices:
+                    with self._query('Office.save', office_fields):
+                        models.Office(**office_query).save()
+                    # read back, in case another run saved it too
+                    with self._query('Office.filter', office_fields):
+                        offices = list(models.Office.objects.filter(**spec))
+                office = self._pick_office(spec, offices)
+                self._office_cache[key] = office
+                return office
         else:
             return None
 
@@ -239,16 +388,16 @@ class BaseTransform(Transform):
 
         return None
 
-    def _make_office_query(self, office_name, raw_result):
+    def _make_office_query(self, office_name, office_name_raw):
         """
-        Gets the right state, place, district for an office
+        Gets the right state, place, district for an office, given its
+        clean name and the raw office string it was cleaned from
         """
 
         office_query = {
             'name': office_name,
             'state': STATE
         }
-        office_name_raw = raw_result.office
 
         if office_name == 'President':
             office_query['state'] = 'US'
@@ -284,32 +433,43 @@ class CreateContestsTransform(BaseTransform):
         contests = []
         seen = set()
 
-        for result in self.get_raw_results():
+        self.prepare_offices()
+
+        rows_read = 0
+        for result in self._scan('RawResult.filter', self.get_raw_results(), ['state', 'place']):
+            rows_read += 1
             key = self._contest_key(result)
             if key not in seen:
                 fields = self.get_contest_fields(result)
                 if fields:
                     fields['updated'] = datetime.now()
                     fields['created'] = datetime.now()
-                    contest = Contest(**fields)
-                    print "   %s" %contest
+                    contest = models.Contest(**fields)
+                    log.debug("   %s", contest)
                     contests.append(contest)
                     seen.add(key)
 
-        Contest.objects.insert(contests, load_bulk=False)
+        self._count('rows_read', rows_read)
+        self._count('rows', len(contests))
+        with self._query('Contest.insert'):
+            models.Contest.objects.insert(contests, load_bulk=False)
 
     def _contest_key(self, raw_result):
         slug = raw_result.contest_slug
         return (raw_result.election_id, slug)
 
     def reverse(self):
-        old = Office.objects.filter(state=STATE)
-        print "\tDeleting %d previously created offices" % old.count()
-        old.delete()
+        old = models.Office.objects.filter(state=STATE)
+        with self._query('Office.count', ['state']):
+            log.info("\tDeleting %d previously created offices", old.count())
+        with self._query('Office.delete', ['state']):
+            old.delete()
 
-        old = Contest.objects.filter(state=STATE)
-        print "\tDeleting %d previously created contests" % old.count()
-        old.delete()
+        old = models.Contest.objects.filter(state=STATE)
+        with self._query('Contest.count', ['state']):
+            log.info("\tDeleting %d previously created contests", old.count())
+        with self._query('Contest.delete', ['state']):
+            old.delete()
 
 
 class CreateCandidatesTransform(BaseTransform):
@@ -322,7 +482,9 @@ class CreateCandidatesTransform(BaseTransform):
         candidates = []
         seen = set()
 
-        for rr in self.get_raw_results():
+        rows_read = 0
+        for rr in self._scan('RawResult.filter', self.get_raw_results(), ['state', 'place']):
+            rows_read += 1
             key = (rr.election_id, rr.contest_slug, rr.candidate_slug)
             if key not in seen:
 
@@ -332,18 +494,22 @@ class CreateCandidatesTransform(BaseTransform):
                     contest = self.get_contest(rr)
                     if contest:
                         fields['contest'] = contest
-                        candidate = Candidate(**fields)
+                        candidate = models.Candidate(**fields)
                         candidates.append(candidate)
 
                 seen.add(key)
 
-
-        Candidate.objects.insert(candidates, load_bulk=False)
+        self._count('rows_read', rows_read)
+        self._count('rows', len(candidates))
+        with self._query('Candidate.insert'):
+            models.Candidate.objects.insert(candidates, load_bulk=False)
 
     def reverse(self):
-        old = Candidate.objects.filter(state=STATE)
-        print "\tDeleting %d previously created candidates" % old.count()
-        old.delete()
+        old = models.Candidate.objects.filter(state=STATE)
+        with self._query('Candidate.count', ['state']):
+            log.info("\tDeleting %d previously created candidates", old.count())
+        with self._query('Candidate.delete', ['state']):
+            old.delete()
 
 
 class CreateResultsTransform(BaseTransform): 
@@ -354,14 +520,18 @@ class CreateResultsTransform(BaseTransform):
     def __init__(self):
         super(CreateResultsTransform, self).__init__()
         self._candidate_cache = {}
+        self.rollups = RollupStore()
 
     def __call__(self):
         results = []
+        rollups = {}
 
         # for now, skip offices that don't have candidates populated
         # e.g. retaining judges, ballot initiatives
         office_to_skip = None
-        for rr in self.get_rawresults():
+        rows_read = 0
+        for rr in self._scan('RawResult.all', self.get_rawresults()):
+            rows_read += 1
             this_office = rr.election_id+rr.office
 
             if this_office != office_to_skip:
@@ -379,12 +549,15 @@ class CreateResultsTransform(BaseTransform):
                             fields['contest'] = fields['candidate'].contest 
                             fields['raw_result'] = rr
 
-                            result = Result(**fields)
+                            result = models.Result(**fields)
                             results.append(result)
-                        except Candidate.MultipleObjectsReturned:
-                            print "*"*50
-                            print "multiple candidates returned"
-                            print "fields: %s" %fields
+
+                            if rr.reporting_level == WARD_LEVEL:
+                                rollups.setdefault(rr.election_id, Rollup()).add(
+                                    rr.office, rr.jurisdiction, rr.full_name, rr.votes)
+                        except models.Candidate.MultipleObjectsReturned:
+                            log.warning("multiple candidates returned - fields: %s", fields)
+                            self._count('multiple_candidates')
 
                     # for now, add results in chunks
                     # instead of all at once at the end
@@ -393,13 +566,21 @@ class CreateResultsTransform(BaseTransform):
                         results = []
 
         self._create_results(results)
+        self._count('rows_read', rows_read)
+
+        for election_id, rollup in rollups.items():
+            with self._query('Rollup.replace'):
+                self.rollups.replace(election_id, 'result', rollup)
 
     def get_results(self):
-        election_ids = self.get_rawresults().distinct('election_id')
-        return Result.objects.filter(election_id__in=election_ids)
+        return models.Result.objects.filter(election_id__in=self.get_election_ids())
+
+    def get_election_ids(self):
+        with self._query('RawResult.distinct'):
+            return self.get_rawresults().distinct('election_id')
 
     def get_rawresults(self):
-        return RawResult.objects
+        return models.RawResult.objects
 
     def get_candidate(self, raw_result, extra={}):
         """
@@ -419,8 +600,9 @@ class CreateResultsTransform(BaseTransform):
             fields.update(extra)
             del fields['source']
             try:
-                candidate = Candidate.objects.get(**fields)
-            except Candidate.DoesNotExist:
+                with self._query('Candidate.get', fields):
+                    candidate = models.Candidate.objects.get(**fields)
+            except models.Candidate.DoesNotExist:
                 raise
             self._candidate_cache[key] = candidate 
             return candidate
@@ -429,13 +611,20 @@ class CreateResultsTransform(BaseTransform):
         """
         Create the Result objects in the database.
         """
-        Result.objects.insert(results, load_bulk=False)
-        print "Created %d results." % len(results)
+        with self._query('Result.insert'):
+            models.Result.objects.insert(results, load_bulk=False)
+        self._count('rows', len(results))
+        log.info("Created %d results.", len(results))
 
     def reverse(self):
-        old_results = self.get_results()
-        print "\tDeleting %d previously loaded results" % old_results.count() 
-        old_results.delete()
+        election_ids = self.get_election_ids()
+        old_results = models.Result.objects.filter(election_id__in=election_ids)
+        with self._query('Result.count', ['election_id']):
+            log.info("\tDeleting %d previously loaded results", old_results.count())
+        with self._query('Result.delete', ['election_id']):
+            old_results.delete()
+        with self._query('Rollup.remove', ['election_id', 'stage']):
+            self.rollups.remove(election_ids, 'result')
 
 
 registry.register('il', CreateContestsTransform)
@@ -0,0 +1,144 @@
+"""
+Opt-in profiling of the datastore calls made by the Chicago transforms.
+
+Every datastore call in the transforms goes through BaseTransform._query,
+or BaseTransform._scan for the loops over raw results, which times the
+cursor's fetches rather than building the (lazy) queryset. While a
+QueryProfiler is active those calls are counted and timed per
+transform, grouped by call site and by query shape (the operation plus the
+fields it filters on), and checked against an optional query budget, e.g.
+in a test:
+
+    with profile_queries(budget={'chicago_create_unique_results': 500}) as profiler:
+        CreateResultsTransform()()
+    print profiler.report()
+
+Exceeding the budget raises QueryBudgetExceeded from the offending call, so
+an N+1 regression fails loudly instead of slowly. Set
+CHICAGO_PROFILE_QUERIES=1 (and optionally CHICAGO_QUERY_BUDGET=<n>) to
+profile a whole process and print the report to stderr when it exits.
+"""
+import atexit
+import os
+import sys
+from contextlib import contextmanager
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryProfiler(object):
+
+    def __init__(self, budget=None):
+        """
+        `budget` is the maximum number of queries a transform may issue
+        while the profiler is active, either one number for every transform
+        or a dict of transform name -> number. None means no limit.
+        """
+        self.budget = budget
+        self.totals = {}
+        self._stats = {}
+
+    def budget_for(self, transform):
+        if isinstance(self.budget, dict):
+            return self.budget.get(transform)
+        return self.budget
+
+    def record(self, transform, call_site, shape, seconds):
+        key = (transform, call_site, shape)
+        stats = self._stats.get(key)
+        if stats is None:
+            self._stats[key] = [1, seconds, seconds]
+        else:
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+        self.totals[transform] = self.totals.get(transform, 0) + 1
+
+        budget = self.budget_for(transform)
+        if budget is not None and self.totals[transform] > budget:
+            raise QueryBudgetExceeded("%s issued more than %d datastore queries, last one: %s at %s"
+                                      % (transform, budget, shape, call_site))
+
+    def _grouped(self, index):
+        grouped = {}
+        for key, (count, total, slowest) in self._stats.items():
+            group = grouped.setdefault((key[0], key[index]), {'count': 0, 'total': 0.0, 'max': 0.0})
+            group['count'] += count
+            group['total'] += total
+            group['max'] = max(group['max'], slowest)
+        return grouped
+
+    def by_call_site(self):
+        """
+        {(transform, call site): {'count', 'total', 'max'}}
+        """
+        return self._grouped(1)
+
+    def by_shape(self):
+        """
+        {(transform, query shape): {'count', 'total', 'max'}}
+        """
+        return self._grouped(2)
+
+    def slowest_shapes(self, n=10):
+        """
+        The n query shapes with the most total time spent in them.
+        """
+        shapes = sorted(self.by_shape().items(), key=lambda item: -item[1]['total'])
+        return shapes[:n]
+
+    def report(self, n=10):
+        lines = []
+        for transform, total in sorted(self.totals.items()):
+            budget = self.budget_for(transform)
+            lines.append('%s: %d queries%s' % (transform, total,
+                                                ' (budget %d)' % budget if budget is not None else ''))
+            for (name, call_site), stats in sorted(self.by_call_site().items()):
+                if name == transform:
+                    lines.append('  %-60s %8d calls %10.3fs' % (call_site, stats['count'], stats['total']))
+
+        lines.append('slowest query shapes:')
+        for (transform, shape), stats in self.slowest_shapes(n):
+            lines.append('  %-60s %8d calls %10.3fs total %8.4fs max'
+                         % ('%s %s' % (transform, shape), stats['count'], stats['total'], stats['max']))
+        return '\n'.join(lines)
+
+
+_active = []
+
+
+def active_profiler():
+    return _active[-1] if _active else None
+
+
+@contextmanager
+def profile_queries(budget=None, profiler=None):
+    profiler = profiler or QueryProfiler(budget)
+    _active.append(profiler)
+    try:
+        yield profiler
+    finally:
+        _active.remove(profiler)
+
+
+def query_shape(op, fields):
+    return '%s(%s)' % (op, ', '.join(sorted(fields)))
+
+
+def call_site(depth):
+    """
+    'function (file:line)' of the frame `depth` levels above the caller.
+    """
+    frame = sys._getframe(depth + 1)
+    return '%s (%s:%d)' % (frame.f_code.co_name, os.path.basename(frame.f_code.co_filename),
+                           frame.f_lineno)
+
+
+if os.environ.get('CHICAGO_PROFILE_QUERIES'):
+    _budget = os.environ.get('CHICAGO_QUERY_BUDGET')
+    _process_profiler = QueryProfiler(int(_budget) if _budget else None)
+    _active.append(_process_profiler)
+    atexit.register(lambda: sys.stderr.write(_process_profiler.report() + '\n'))
@@ -0,0 +1,407 @@
+import BaseHTTPServer
+import json
+import os
+import socket
+import sqlite3
+import sys
+import time
+import urllib2
+
+from .metrics import log
+
+# units are claimed depth first, so that elections finish (and get
+# assembled) as early as possible instead of all at the very end
+DEPTH = {
+    'election': 0,
+    'contest': 1,
+    'ward': 2,
+}
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+# what RemoteWorkQueue can call on the WorkQueue behind a QueueServer
+REMOTE_METHODS = set(['add', 'claim', 'renew', 'complete', 'fail', 'assemblable', 'claim_assembly',
+                      'unassemble', 'contest_results', 'contest_links', 'stats'])
+
+DEFAULT_PORT = 8765
+
+
+class WorkQueue(object):
+    """
+    Durable, SQLite-backed queue of scrape work units.
+
+    A full scrape is broken into election -> contest -> ward page units.
+    Processing an election unit enqueues its contests, processing a contest
+    unit enqueues its ward pages, and each ward unit stores the parsed ward
+    result. Once every unit of an election is finished, exactly one worker
+    gets to assemble the election json.
+
+    Any number of worker processes on the same machine can share the
+    database directly. Workers on other machines go through a QueueServer
+    instead (see RemoteWorkQueue): the database must not be shared over a
+    network filesystem (NFS, SMB), SQLite's locking isn't reliable there.
+    Claimed units are leased, and a unit whose lease expires (e.g. its
+    worker died) is handed out again. Units that keep failing, or keep
+    losing their lease, are given up on after `max_attempts`.
+    """
+
+    def __init__(self, path='scrape_queue.db', lease_seconds=300, max_attempts=5):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        # autocommit mode, transactions are started explicitly
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._create_tables()
+
+    def _create_tables(self):
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS units
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 kind TEXT NOT NULL,
+                 depth INTEGER NOT NULL,
+                 election TEXT NOT NULL,
+                 contest TEXT NOT NULL DEFAULT '',
+                 ward TEXT NOT NULL DEFAULT '',
+                 url TEXT NOT NULL DEFAULT '',
+                 contest_position INTEGER NOT NULL DEFAULT 0,
+                 position INTEGER NOT NULL DEFAULT 0,
+                 state TEXT NOT NULL DEFAULT 'pending',
+                 lease_owner TEXT,
+                 lease_expires REAL,
+                 attempts INTEGER NOT NULL DEFAULT 0,
+                 result TEXT,
+                 error TEXT,
+                 UNIQUE (kind, election, contest, ward))""")
+        self._conn.execute("""CREATE INDEX IF NOT EXISTS units_claim
+                ON units (state, depth, id)""")
+        self._conn.execute("""CREATE INDEX IF NOT EXISTS units_election
+                ON units (election, state)""")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS elections
+                (election TEXT PRIMARY KEY,
+                 assembled INTEGER NOT NULL DEFAULT 0)""")
+
+    def add(self, kind, election, contest='', ward='', url='', contest_position=0, position=0):
+        """
+        Enqueue a unit. Adding a unit that is already queued is a no-op, so
+        a unit that is processed twice (e.g. after a lease expired) does not
+        duplicate its children.
+        """
+        self._conn.execute("""INSERT OR IGNORE INTO units
+                (kind, depth, election, contest, ward, url, contest_position, position)
+                VALUES (?,?,?,?,?,?,?,?)""",
+                (kind, DEPTH[kind], election, contest, ward or '', url, contest_position, position))
+        self._conn.execute("INSERT OR IGNORE INTO elections (election) VALUES (?)", (election,))
+
+    def claim(self, worker):
+        """
+        Lease the next available unit to `worker`. Returns None when there
+        is nothing left to claim.
+        """
+        now = time.time()
+
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            # a unit that keeps killing or hanging its worker never gets
+            # to fail(), so its attempts are checked here
+            self._conn.execute("""UPDATE units
+                    SET state = ?, error = ?, lease_owner = NULL, lease_expires = NULL
+                    WHERE state = ? AND lease_expires < ? AND attempts >= ?""",
+                    (FAILED, 'lease expired on the last attempt', LEASED, now, self.max_attempts))
+            row = self._conn.execute("""SELECT * FROM units
+                    WHERE state = ? OR (state = ? AND lease_expires < ? AND attempts < ?)
+                    ORDER BY depth DESC, id
+                    LIMIT 1""", (PENDING, LEASED, now, self.max_attempts)).fetchone()
+            if row is not None:
+                self._conn.execute("""UPDATE units
+                        SET state = ?, lease_owner = ?, lease_expires = ?, attempts = attempts + 1
+                        WHERE id = ?""", (LEASED, worker, now + self.lease_seconds, row['id']))
+            self._conn.execute("COMMIT")
+        except:
+            self._conn.execute("ROLLBACK")
+            raise
+
+        if row is None:
+            return None
+
+        unit = dict(row)
+        unit['attempts'] += 1
+        return unit
+
+    def renew(self, unit, worker):
+        """
+        Extend the lease on a unit that is taking a long time.
+        """
+        self._conn.execute("""UPDATE units SET lease_expires = ?
+                WHERE id = ? AND state = ? AND lease_owner = ?""",
+                (time.time() + self.lease_seconds, unit['id'], LEASED, worker))
+
+    def complete(self, unit, worker, result=None):
+        """
+        Mark a unit done, storing its (json serializable) result. Returns
+        False if the lease was lost to another worker in the meantime.
+        """
+        cursor = self._conn.execute("""UPDATE units
+                SET state = ?, result = ?, lease_owner = NULL, lease_expires = NULL
+                WHERE id = ? AND state = ? AND lease_owner = ?""",
+                (DONE, json.dumps(result), unit['id'], LEASED, worker))
+        return cursor.rowcount == 1
+
+    def fail(self, unit, worker, error):
+        """
+        Release a unit after an error so it can be retried, or give up on it
+        once it has used up its attempts.
+        """
+        state = FAILED if unit['attempts'] >= self.max_attempts else PENDING
+        self._conn.execute("""UPDATE units
+                SET state = ?, error = ?, lease_owner = NULL, lease_expires = NULL
+                WHERE id = ? AND state = ? AND lease_owner = ?""",
+                (state, error, unit['id'], LEASED, worker))
+
+    def assemblable(self):
+        """
+        Returns the elections that are ready to be assembled: all their
+        units are finished, their election unit succeeded and nobody has
+        assembled them yet. Workers check this after every claim, since
+        giving up on an expired lease in claim can finish an election
+        nobody is working on anymore.
+        """
+        rows = self._conn.execute("""SELECT election FROM elections
+                WHERE assembled = 0
+                AND EXISTS (SELECT 1 FROM units WHERE units.election = elections.election
+                            AND kind = 'election' AND state = ?)
+                AND NOT EXISTS (SELECT 1 FROM units WHERE units.election = elections.election
+                                AND state IN (?, ?))
+                ORDER BY election""", (DONE, PENDING, LEASED)).fetchall()
+        return [row['election'] for row in rows]
+
+    def claim_assembly(self, election):
+        """
+        Returns True, exactly once, when all units of an election are
+        finished and its election unit succeeded. The caller is then
+        responsible for assembling the election json.
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            unfinished = self._conn.execute("""SELECT COUNT(*) FROM units
+                    WHERE election = ? AND state IN (?, ?)""",
+                    (election, PENDING, LEASED)).fetchone()[0]
+            enumerated = self._conn.execute("""SELECT COUNT(*) FROM units
+                    WHERE election = ? AND kind = 'election' AND state = ?""",
+                    (election, DONE)).fetchone()[0]
+
+            claimed = False
+            if not unfinished and enumerated:
+                cursor = self._conn.execute("""UPDATE elections SET assembled = 1
+                        WHERE election = ? AND assembled = 0""", (election,))
+                claimed = cursor.rowcount == 1
+            self._conn.execute("COMMIT")
+        except:
+            self._conn.execute("ROLLBACK")
+            raise
+
+        return claimed
+
+    def unassemble(self, election):
+        """
+        Hand an election back if assembling it failed.
+        """
+        self._conn.execute("UPDATE elections SET assembled = 0 WHERE election = ?", (election,))
+
+    def contest_results(self, election):
+        """
+        Returns the finished contests of an election in their original
+        order, as (contest name, [ward results]) pairs.
+        """
+        contests = self._conn.execute("""SELECT contest, position FROM units
+                WHERE election = ? AND kind = 'contest' AND state = ?
+                ORDER BY position""", (election, DONE)).fetchall()
+        wards = self._conn.execute("""SELECT contest_position, result FROM units
+                WHERE election = ? AND kind = 'ward' AND state = ?
+                ORDER BY contest_position, position""", (election, DONE)).fetchall()
+
+        results = {}
+        for row in wards:
+            ward_result = json.loads(row['result'])
+            if ward_result:
+                results.setdefault(row['contest_position'], []).append(ward_result)
+
+        return [(row['contest'], results.get(row['position'], [])) for row in contests]
+
+    def contest_links(self, election):
+        """
+        Returns the enumerated contests of an election in their original
+        order, as (contest name, [(ward, url)]) pairs.
+        """
+        contests = self._conn.execute("""SELECT contest, position FROM units
+                WHERE election = ? AND kind = 'contest' AND state = ?
+                ORDER BY position""", (election, DONE)).fetchall()
+        wards = self._conn.execute("""SELECT contest_position, ward, url FROM units
+                WHERE election = ? AND kind = 'ward'
+                ORDER BY contest_position, position""", (election,)).fetchall()
+
+        links = {}
+        for row in wards:
+            links.setdefault(row['contest_position'], []).append((row['ward'], row['url']))
+
+        return [(row['contest'], links.get(row['position'], [])) for row in contests]
+
+    def stats(self):
+        """
+        Returns the number of units in each state, per kind of unit.
+        """
+        stats = {}
+        for row in self._conn.execute("SELECT kind, state, COUNT(*) FROM units GROUP BY kind, state"):
+            stats.setdefault(row[0], {})[row[1]] = row[2]
+        return stats
+
+
+class QueueServer(BaseHTTPServer.HTTPServer):
+    """
+    Serves a WorkQueue over HTTP, for workers on other machines. Each call
+    is a POST to /<method> with a json {"args": [...], "kwargs": {...}}
+    body, answered with {"result": ...}.
+
+    Requests are handled one at a time, on the thread that owns the SQLite
+    connection, so the queue's transactions work as they do locally.
+    """
+
+    def __init__(self, queue, port=DEFAULT_PORT, host=''):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), QueueRequestHandler)
+        self.queue = queue
+
+
+class QueueRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        method = self.path.strip('/')
+        if method not in REMOTE_METHODS:
+            return self._respond(404, {'error': 'no such method: %s' % method})
+
+        try:
+            call = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+            result = getattr(self.server.queue, method)(*call.get('args', []), **call.get('kwargs', {}))
+        except Exception as e:
+            log.warning("queue call %s failed: %r", method, e)
+            return self._respond(500, {'error': repr(e)})
+        self._respond(200, {'result': result})
+
+    def _respond(self, status, body):
+        content = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        log.debug("%s - %s", self.client_address[0], format % args)
+
+
+class RemoteQueueError(Exception):
+    pass
+
+
+class RemoteWorkQueue(object):
+    """
+    A WorkQueue served by a QueueServer on another machine, e.g.
+
+        queue = RemoteWorkQueue('http://queuehost:8765')
+        Scraper().work(queue, assemble=False)
+
+    It has the WorkQueue methods in REMOTE_METHODS. Units are leased as
+    they are locally, so a worker (or machine) that goes away only delays
+    its units until their leases expire.
+    """
+
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def __getattr__(self, name):
+        if name not in REMOTE_METHODS:
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self._call(name, args, kwargs)
+
+    def _call(self, method, args, kwargs):
+        request = urllib2.Request('%s/%s' % (self.url, method),
+                                  json.dumps({'args': args, 'kwargs': kwargs}),
+                                  {'Content-Type': 'application/json'})
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+        except urllib2.HTTPError as e:
+            raise RemoteQueueError("%s: %s" % (method, e.read()))
+        return json.load(response)['result']
+
+
+def default_worker_id():
+    return '%s-%s' % (socket.gethostname(), os.getpid())
+
+
+def serve(queue, port=DEFAULT_PORT, scraper=None, poll_seconds=1):
+    """
+    Serves `queue` to remote workers until interrupted. With a scraper,
+    elections are assembled here as they become ready, so their json is
+    written on this machine rather than on whichever worker finished last.
+    """
+    server = QueueServer(queue, port)
+    server.timeout = poll_seconds
+    log.info("serving %s on port %d", getattr(queue, 'path', queue), port)
+    try:
+        while True:
+            server.handle_request()
+            if scraper is not None:
+                try:
+                    scraper.assemble_ready(queue)
+                except Exception:
+                    # handed back by assemble_ready, and retried next time
+                    log.exception("assembling failed")
+    finally:
+        server.server_close()
+
+
+def main(argv=None):
+    """
+    python -m openelex.us.il.places.chicago.workqueue enqueue|work|status [db|url]
+    python -m openelex.us.il.places.chicago.workqueue serve [db] [port]
+
+    Workers on other machines work off `serve`, e.g.
+    `work http://queuehost:8765`; the election json is written by `serve`.
+    """
+    from .scraper import Scraper
+
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in ('enqueue', 'work', 'status', 'serve'):
+        print main.__doc__.strip()
+        return 1
+
+    remote = argv[1:2] and argv[1].startswith(('http://', 'https://'))
+    if remote:
+        queue = RemoteWorkQueue(argv[1])
+        # shared by the workers on this machine, every machine has its own
+        rate_limit_file = 'scrape_queue.ratelimit'
+    else:
+        queue = WorkQueue(*argv[1:2])
+        rate_limit_file = queue.path + '.ratelimit'
+
+    if argv[0] == 'enqueue':
+        print "enqueued %d elections" % Scraper().enqueue(queue)
+    elif argv[0] == 'work':
+        # every worker on the queue (and machine) draws from the same rate limit
+        Scraper(rate_limit_file=rate_limit_file).work(queue, assemble=not remote)
+    elif argv[0] == 'serve':
+        port = int(argv[2]) if len(argv) > 2 else DEFAULT_PORT
+        try:
+            serve(queue, port, Scraper())
+        except KeyboardInterrupt:
+            pass
+
+    print json.dumps(queue.stats(), indent=4, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from openelex.us.il.places.chicago.scraper import Scraper
+from openelex.us.il.places.chicago.workqueue import (DONE, FAILED, QueueServer, RemoteWorkQueue,
+                                                     WorkQueue)
+
+
+class RecordingScraper(Scraper):
+    """
+    Records the elections it assembles instead of writing them out.
+    """
+
+    def __init__(self):
+        super(RecordingScraper, self).__init__()
+        self.assembled = []
+
+    def write_manifest(self, elec_name, contests):
+        pass
+
+    def write_election_json(self, elec_name, contest_records):
+        self.assembled.append(elec_name)
+
+
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def _enumerated_election(self, queue, worker):
+        queue.add('election', 'E1')
+        unit = queue.claim(worker)
+        queue.add('contest', 'E1', 'MAYOR', position=0)
+        queue.complete(unit, worker)
+
+    def test_expired_last_attempt_is_assembled(self):
+        queue = WorkQueue('queue.db', lease_seconds=0.01, max_attempts=1)
+        self._enumerated_election(queue, 'w1')
+
+        # the contest's worker dies on the unit's only attempt
+        self.assertEqual(queue.claim('w1')['kind'], 'contest')
+        time.sleep(0.05)
+
+        scraper = RecordingScraper()
+        scraper.work(queue, 'w2')
+
+        self.assertEqual(scraper.assembled, ['E1'])
+        self.assertEqual(queue.stats()['contest'], {FAILED: 1})
+        self.assertEqual(queue.assemblable(), [])
+        self.assertFalse(queue.claim_assembly('E1'))
+
+    def test_assemblable_waits_for_unfinished_units(self):
+        queue = WorkQueue('queue.db')
+        self._enumerated_election(queue, 'w1')
+        self.assertEqual(queue.assemblable(), [])
+
+        unit = queue.claim('w1')
+        self.assertEqual(queue.assemblable(), [])
+        queue.complete(unit, 'w1')
+        self.assertEqual(queue.assemblable(), ['E1'])
+
+    def test_remote_queue(self):
+        served = {}
+        ready = threading.Event()
+
+        def serve():
+            # the queue's connection belongs to the thread serving it
+            server = QueueServer(WorkQueue('queue.db'), port=0, host='127.0.0.1')
+            served['server'] = server
+            ready.set()
+            server.serve_forever(poll_interval=0.01)
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        ready.wait()
+        try:
+            queue = RemoteWorkQueue('http://127.0.0.1:%d' % served['server'].server_port)
+            self._enumerated_election(queue, 'w1')
+
+            unit = queue.claim('w2')
+            self.assertEqual((unit['kind'], unit['contest'], unit['attempts']), ('contest', 'MAYOR', 1))
+            self.assertTrue(queue.complete(unit, 'w2', None))
+
+            self.assertEqual(queue.claim('w2'), None)
+            self.assertEqual(queue.stats(), {'election': {DONE: 1}, 'contest': {DONE: 1}})
+            self.assertEqual(queue.assemblable(), ['E1'])
+            self.assertTrue(queue.claim_assembly('E1'))
+            self.assertFalse(queue.claim_assembly('E1'))
+        finally:
+            served['server'].shutdown()
+            thread.join()
+            served['server'].server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()